@@ -4,18 +4,14 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 
 # import pandas and plotly graph object
-import pandas as pd
 import plotly.graph_objs as go
 
-from df_wrangling import identify_the_winners, clean_df
+from df_wrangling import identify_the_winners, load_results
 
 app = dash.Dash(external_stylesheets=[dbc.themes.JOURNAL])
 
-# read in the data
-ge_df = pd.read_excel(
-    "./data/2017_General_Election_Results.xls"
-)
-ge_df = clean_df(ge_df)
+# read in the data (cached after the first run)
+ge_df = load_results()
 
 
 """
@@ -4,19 +4,15 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 
-import pandas as pd
 import plotly.graph_objs as go
 import json
 
-from df_wrangling import clean_df, swing_to_new_party, identify_the_winners
+from df_wrangling import load_results, swing_to_new_party, identify_the_winners
 
 app = dash.Dash(external_stylesheets=[dbc.themes.JOURNAL])
 
-# read in the data
-ge_df = pd.read_excel(
-    "./data/2017_General_Election_Results.xls"
-)
-ge_df = clean_df(ge_df)
+# read in the data (cached after the first run)
+ge_df = load_results()
 
 
 
@@ -4,25 +4,30 @@ import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 
-import pandas as pd
 import plotly.graph_objs as go
 import json
 
 from df_wrangling import (
-    clean_df,
-    swing_to_new_party,
+    load_results,
+    SwingEngine,
     identify_the_winners,
-    make_party_json_list,
+    make_winners_json_list,
+    join_features,
+    report_unmatched,
     mapbox_access_token,
 )
 
 app = dash.Dash(external_stylesheets=[dbc.themes.JOURNAL])
 
-# read in the data
-ge_df = pd.read_excel(
-    "./data/2017_General_Election_Results.xls"
-)
-ge_df = clean_df(ge_df)
+# read in the data (cached after the first run)
+ge_df = load_results()
+
+# vote matrix shared by the callbacks
+swing_engine = SwingEngine(ge_df)
+
+# each boundary's row of the vote matrix, checked once here
+feature_join = join_features(swing_engine.codes)
+report_unmatched(feature_join)
 
 
 """
@@ -191,7 +196,10 @@ callback functions
 
 
 @app.callback(
-    Output("new_outcome_graph", "children"),
+    [
+        Output("new_outcome_graph", "children"),
+        Output("chloro_map", "figure"),
+    ],
     [
         Input("con_slider", "value"),
         Input("lab_slider", "value"),
@@ -201,7 +209,7 @@ callback functions
         Input("pc_slider", "value"),
     ],
 )
-def plot_new_outcome(
+def update_new_outcome(
     con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
 ):
 
@@ -214,7 +222,15 @@ def plot_new_outcome(
         "PC": plaid_swing,
     }
 
-    adjusted_winners_df = swing_to_new_party(ge_df, party_swings)
+    # one swing calculation feeds both the bar chart and the map
+    result = swing_engine.apply(party_swings)
+
+    return plot_new_outcome(result), plot_new_choropleth(result)
+
+
+def plot_new_outcome(result):
+
+    adjusted_winners_df = swing_engine.seats_table(result)
 
     graph = dcc.Graph(
         id="new_winners_graph",
@@ -237,29 +253,7 @@ def plot_new_outcome(
     return graph
 
 
-@app.callback(
-    Output("chloro_map", "figure"),
-    [
-        Input("con_slider", "value"),
-        Input("lab_slider", "value"),
-        Input("snp_slider", "value"),
-        Input("ld_slider", "value"),
-        Input("green_slider", "value"),
-        Input("pc_slider", "value"),
-    ],
-)
-def plot_new_choropleth(
-    con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
-):
-
-    party_swings = {
-        "C": con_swing,
-        "Lab": lab_swing,
-        "SNP": snp_swing,
-        "LD": ld_swing,
-        "Green": green_swing,
-        "PC": plaid_swing,
-    }
+def plot_new_choropleth(result):
 
     colors_dict = {
         'Con': '#0087DC',
@@ -272,7 +266,9 @@ def plot_new_choropleth(
         'other': '#bbbbbb',
     }
 
-    party_json_list = make_party_json_list(ge_df, party_swings)
+    party_json_list = make_winners_json_list(
+        swing_engine.codes, swing_engine.winning_parties(result), feature_join
+    )
     
     data = go.Data([
         go.Scattermapbox(
@@ -3,26 +3,170 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
+from dash import Patch, dash_table
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 import json
+import uuid
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
 
 from df_wrangling import (
-    clean_df,
-    swing_to_new_party,
+    load_bundle,
+    report_unmatched,
     identify_the_winners,
-    make_party_json_list,
+    map_layer_index,
     mapbox_access_token,
+    party_renaming_dict,
+)
+from geometry import serve_geometry, detail_level_for_zoom
+from scenarios import (
+    monte_carlo,
+    seat_projection_table,
+    FlipIndex,
+    SeatTarget,
+    majority_seats,
+    minimal_swing,
+    sensitivity_grid,
+    swing_sweep,
+    RegionalPR,
 )
 
 app = dash.Dash(external_stylesheets=[dbc.themes.JOURNAL])
 
-# read in the data
-ge_df = pd.read_excel(
-    "./data/2017_General_Election_Results.xls"
+# results and boundaries compiled ahead of time with: python -m df_wrangling build
+# a year's arrays are only read in when it is first selected
+bundle = load_bundle()
+results_years = bundle.years
+default_year = max(results_years)
+slider_parties = ["C", "Lab", "SNP", "LD", "Green", "PC"]
+
+# the map's locations are the boundary features; each year's join to them
+# was worked out when the bundle was built, and any gaps are reported here
+map_codes = bundle.feature_ids
+for year in results_years:
+    report_unmatched(bundle.feature_join(year), str(year))
+
+YearData = namedtuple(
+    "YearData",
+    ["ge_df", "engine", "flip_index", "regional_pr", "constituency_names", "map_order"],
 )
-ge_df = clean_df(ge_df)
+
+
+# only the most recently used years are kept, so memory per worker stays
+# flat however many years there are; nothing else holds on to a year's
+# models, the default year's included
+@lru_cache(maxsize=2)
+def year_data(year):
+    ge_df = bundle.results(year)
+    # vote matrix shared by the callbacks
+    engine = bundle.engine(year)
+
+    return YearData(
+        ge_df,
+        engine,
+        # where each seat changes hands as a single party's vote swings
+        FlipIndex(engine, slider_parties),
+        # list PR by region, each region electing as many members as it has seats
+        RegionalPR(engine, ge_df["Region"]),
+        dict(zip(ge_df["Code"], ge_df["Constituency"])),
+        # each map location's row in this year's results, -1 where it has none
+        bundle.feature_join(year).rows,
+    )
+
+
+def map_z(data, layers):
+    # reorder map layers (the last axis) to the map's locations, leaving
+    # blank any the year has no result for
+    z = layers[..., data.map_order]
+    missing = data.map_order < 0
+    if missing.any():
+        if z.dtype.kind in "biuf":
+            z = z.astype(float)
+            z[..., missing] = np.nan
+        else:
+            z = z.astype(object)
+            z[..., missing] = None
+    return z
+
+
+def map_text(data):
+    # hover text for the map's locations: the year's constituency names
+    return map_z(data, data.ge_df["Constituency"].to_numpy())
+
+
+# grids for the sensitivity heatmap, kept by year rather than by engine so
+# they don't hold on to years year_data has let go of
+@lru_cache(maxsize=32)
+def year_sensitivity_grid(year, party_x, party_y):
+    return sensitivity_grid(year_data(year).engine, party_x, party_y)
+
+
+# simulation processes per server process, started on the first Monte Carlo
+# run and reused; under gunicorn each worker has this many
+monte_carlo_workers = 2
+
+# last swing result per browser session, so dragging one slider only
+# recalculates that party; the oldest sessions are dropped beyond the limit.
+# Each result is about 57KB (the full vote matrix, kept at full precision so
+# updates stay identical to apply), so this is about 6MB per worker
+session_results = OrderedDict()
+session_results_lock = threading.Lock()
+max_sessions = 100
+
+# swing results by year and slider values, shared by every callback the
+# sliders drive, so each slider state is calculated once per worker; the
+# entries are mostly the same objects session_results holds
+swing_results = OrderedDict()
+swing_results_lock = threading.Lock()
+max_swing_results = 32
+
+
+def slider_swings(*values):
+    return dict(zip(slider_parties, values))
+
+
+def swing_result(year, party_swings, previous=None):
+    """The SwingResult for a year and slider state, calculated once and shared.
+
+    previous is a result for the same year with at most one slider
+    different, from which only that party is recalculated.
+    """
+    engine = year_data(year).engine
+    key = (year, tuple(party_swings.values()))
+    # held while calculating, so the callbacks a slider move sets off at
+    # once wait for one calculation rather than each doing their own
+    with swing_results_lock:
+        if key in swing_results:
+            swing_results.move_to_end(key)
+            return swing_results[key]
+        if previous is not None:
+            result = engine.update(previous, party_swings)
+        else:
+            result = engine.apply(party_swings)
+        swing_results[key] = result
+        while len(swing_results) > max_swing_results:
+            swing_results.popitem(last=False)
+    return result
+
+# boundaries are fetched by the browser from cacheable URLs, one per level of detail
+boundary_urls = [
+    app.get_relative_path(
+        serve_geometry(
+            app.server,
+            "boundaries-lod{}".format(level),
+            bundle.geometry(level),
+            bundle.compressed_geometry(level),
+            # the bundle's hash covers every level, and saves hashing them here
+            version=bundle.content_hash,
+        )
+    )
+    for level in range(len(bundle.detail_level_zooms))
+]
+initial_zoom = 5.0
 
 
 """
@@ -30,9 +174,9 @@ Static Functions
 """
 
 
-def plot_the_winners():
+def plot_the_winners(year):
 
-    ge_winners_df = identify_the_winners(ge_df)
+    ge_winners_df = identify_the_winners(year_data(year).ge_df)
 
     graph = dcc.Graph(
         id="winners_graph",
@@ -55,38 +199,138 @@ def plot_the_winners():
     return graph
 
 
+def outcome_options(engine, prefix=""):
+    return [
+        {"label": prefix + party_renaming_dict.get(p, p), "value": p}
+        for p in engine.outcomes
+    ]
+
+
+def transfer_columns(engine):
+    return [{"name": "From", "id": "from", "editable": False}] + [
+        {
+            "name": party_renaming_dict.get(p, p),
+            "id": p,
+            "type": "numeric",
+            # anything that isn't a number is read as no transfer
+            "on_change": {"action": "coerce", "failure": "default"},
+            "validation": {"default": 0},
+        }
+        for p in engine.outcomes
+    ]
+
+
+def transfer_rows(engine):
+    # the diagonal shows what each party keeps
+    return [
+        dict(
+            {"from": party_renaming_dict.get(p, p), "party": p},
+            **{q: 100 if q == p else 0 for q in engine.outcomes}
+        )
+        for p in engine.parties
+    ]
+
+
+def transfer_styles(engine):
+    # a DataTable can't lock single cells, so the diagonal is shaded instead
+    # and plot_transfers writes over anything typed into it
+    return [
+        {
+            "if": {"filter_query": '{{party}} = "{}"'.format(p), "column_id": p},
+            "backgroundColor": "rgb(230, 230, 230)",
+            "color": "rgb(120, 120, 120)",
+        }
+        for p in engine.parties
+    ]
+
+
 """
 Page Contents
 """
-chloro_map = dcc.Graph(
-    id="chloro_map",
-    figure=go.Figure(
-        data=go.Data([go.Scattermapbox(lat=["52"], lon=["0"], mode="markers")]),
-        layout=go.Layout(
-            height=800,
-            autosize=True,
-            hovermode="closest",
-            legend=dict(
-                x=0.8,
-                y=0.5,
-                font=dict(family="sans-serif", size=12, color="#000"),
-                bgcolor="#E2E2E2",
-            ),
-            mapbox=dict(
-                accesstoken=mapbox_access_token,
-                bearing=0,
-                center=dict(lat=53, lon=0),
-                pitch=0,
-                zoom=5.0,
-                style="dark",
-            ),
-            margin={"l": 0, "r": 0, "b": 0, "t": 20, "pad": 4},
+# one colour per map layer from df_wrangling.map_layer_parties, then "other"
+colors_dict = {
+    'Con': '#0087DC',
+    'Lab': '#DC241f',
+    'SNP': '#f4f142',
+    'LD': '#FAA61A',
+    'Green': '#6AB023',
+    'PC': '#2f8c1a',
+    'New': '#a1edd8',
+    'other': '#bbbbbb',
+}
+
+# discrete colour scale: layer i is drawn with the i-th colour
+n_colors = len(colors_dict)
+party_colorscale = []
+for i, color in enumerate(colors_dict.values()):
+    party_colorscale += [[i / n_colors, color], [(i + 1) / n_colors, color]]
+
+
+def party_map_trace(data, z):
+
+    # the browser fetches (and caches) the boundaries itself; callbacks only update z
+    return go.Choroplethmapbox(
+        geojson=boundary_urls[detail_level_for_zoom(initial_zoom)],
+        featureidkey="properties.id",
+        locations=map_codes,
+        z=z,
+        zmin=-0.5,
+        zmax=n_colors - 0.5,
+        colorscale=party_colorscale,
+        colorbar=dict(
+            tickvals=list(range(n_colors)),
+            ticktext=list(colors_dict.keys()),
         ),
-    ),
+        text=map_text(data),
+        hoverinfo="text",
+        marker=dict(opacity=0.6, line=dict(width=0.5)),
+    )
+
+
+map_layout = dict(
+    accesstoken=mapbox_access_token,
+    bearing=0,
+    center=dict(lat=53, lon=0),
+    pitch=0,
+    zoom=initial_zoom,
+    style="dark",
+)
+
+
+def plot_base_choropleth():
+
+    year = year_data(default_year)
+    data = [
+        party_map_trace(year, map_z(year, map_layer_index(year.ge_df["Majority Party"])))
+    ]
+
+    layout = go.Layout(
+        height=800,
+        autosize=True,
+        hovermode="closest",
+        mapbox=map_layout,
+        margin={"l": 0, "r": 0, "b": 0, "t": 20, "pad": 4},
+    )
+
+    return go.Figure(data=data, layout=layout)
+
+
+chloro_map = dcc.Graph(id="chloro_map", figure=plot_base_choropleth())
+map_detail_level = dcc.Store(
+    id="map_detail_level", data=detail_level_for_zoom(initial_zoom)
 )
 
 heading_card = dbc.Card(
-    [html.H3("General Election Results"), html.Hr()],
+    [
+        html.H3("General Election Results"),
+        html.Hr(),
+        dcc.Dropdown(
+            id="year",
+            options=[{"label": str(year), "value": year} for year in results_years],
+            value=default_year,
+            clearable=False,
+        ),
+    ],
     body=True,
     style={"height": "100%"},
 )
@@ -95,7 +339,7 @@ winners_chart = dbc.Card(
     [
         html.H3("Number of constituencies won by each party"),
         html.Hr(),
-        html.Div([plot_the_winners()]),
+        html.Div(id="winners_graph_div", children=[plot_the_winners(default_year)]),
     ],
     body=True,
     style={"height": "100%"},
@@ -106,6 +350,7 @@ new_winners_chart = dbc.Card(
         html.H3("New number of constituencies won by each party"),
         html.Hr(),
         html.Div(id="new_outcome_graph", children=[]),
+        dcc.Store(id="session_id"),
     ],
     body=True,
     style={"height": "100%"},
@@ -156,7 +401,267 @@ pc_scale = dbc.Card(
     body=True,
 )
 chloropleth_map = dbc.Card(
-    [html.H3("Choropleth map"), chloro_map], body=True, style={"height": "100%"}
+    [html.H3("Choropleth map"), chloro_map, map_detail_level],
+    body=True,
+    style={"height": "100%"},
+)
+
+# the browser only hints at these limits, so plot_monte_carlo enforces them too
+min_simulations = 1000
+max_simulations = 200000
+
+monte_carlo_card = dbc.Card(
+    [
+        html.H3("Monte Carlo seat projection"),
+        html.P(
+            "Each party's swing is drawn from a normal distribution centred "
+            "on its slider, with the spread below as standard deviation."
+        ),
+        dbc.Row(
+            [
+                dbc.Col(
+                    [
+                        html.Label("Simulations"),
+                        dcc.Input(
+                            id="mc_simulations",
+                            type="number",
+                            min=min_simulations,
+                            max=max_simulations,
+                            step=1000,
+                            value=20000,
+                        ),
+                    ]
+                ),
+                dbc.Col(
+                    [
+                        html.Label("Spread"),
+                        dcc.Slider(
+                            min=0,
+                            max=30,
+                            marks={i: str(i) for i in range(0, 35, 5)},
+                            value=10,
+                            id="mc_spread",
+                        ),
+                    ]
+                ),
+                dbc.Col([dbc.Button("Run", id="mc_run", color="primary")]),
+            ]
+        ),
+        html.Hr(),
+        html.Div(id="mc_output", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+marginal_seats_card = dbc.Card(
+    [
+        html.H3("Most marginal seats"),
+        html.P("Seats that change hands at the smallest swing from one party."),
+        dcc.Dropdown(
+            id="marginal_party",
+            options=[
+                {"label": party_renaming_dict.get(p, p), "value": p}
+                for p in slider_parties
+            ],
+            value="C",
+            clearable=False,
+        ),
+        html.Br(),
+        html.Div(id="marginal_seats", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+tipping_point_card = dbc.Card(
+    [
+        html.H3("Tipping point finder"),
+        html.P("The smallest swing to the new party that reaches a seat target."),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dcc.Dropdown(
+                        id="target_party",
+                        options=outcome_options(year_data(default_year).engine),
+                        value="New",
+                        clearable=False,
+                    )
+                ),
+                dbc.Col(
+                    dcc.RadioItems(
+                        id="target_direction",
+                        options=[
+                            {"label": " at least", "value": "at_least"},
+                            {"label": " fewer than", "value": "fewer"},
+                        ],
+                        value="at_least",
+                    )
+                ),
+                dbc.Col(
+                    dcc.Input(
+                        id="target_seats",
+                        type="number",
+                        min=0,
+                        max=len(year_data(default_year).ge_df),
+                        value=majority_seats(year_data(default_year).engine),
+                    )
+                ),
+            ]
+        ),
+        html.Br(),
+        html.Label("Parties that may swing"),
+        dcc.Checklist(
+            id="target_swing_parties",
+            options=[
+                {"label": " " + party_renaming_dict.get(p, p), "value": p}
+                for p in slider_parties
+            ],
+            value=["C", "Lab"],
+            inline=True,
+        ),
+        html.Br(),
+        dbc.Button("Find", id="target_run", color="primary"),
+        html.Hr(),
+        html.Div(id="tipping_point", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+swing_party_options = [
+    {"label": party_renaming_dict.get(p, p), "value": p} for p in slider_parties
+]
+
+sensitivity_card = dbc.Card(
+    [
+        html.H3("Sensitivity to two parties' swings"),
+        html.P("Seats won by the chosen party over every pair of swings."),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dcc.Dropdown(
+                        id="sensitivity_x",
+                        options=swing_party_options,
+                        value="C",
+                        clearable=False,
+                    )
+                ),
+                dbc.Col(
+                    dcc.Dropdown(
+                        id="sensitivity_y",
+                        options=swing_party_options,
+                        value="Lab",
+                        clearable=False,
+                    )
+                ),
+                dbc.Col(
+                    dcc.Dropdown(
+                        id="sensitivity_outcome",
+                        options=outcome_options(year_data(default_year).engine),
+                        value="New",
+                        clearable=False,
+                    )
+                ),
+            ]
+        ),
+        html.Div(id="sensitivity_graph", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+swing_sweep_card = dbc.Card(
+    [
+        html.H3("Swing sweep"),
+        html.P(
+            "Animate one party's swing from 0 to 100%, with the other sliders "
+            "held where they are. Press play once the chart has loaded."
+        ),
+        dbc.Row(
+            [
+                dbc.Col(
+                    dcc.Dropdown(
+                        id="sweep_party",
+                        options=swing_party_options,
+                        value="C",
+                        clearable=False,
+                    )
+                ),
+                dbc.Col([dbc.Button("Build animation", id="sweep_run", color="primary")]),
+            ]
+        ),
+        html.Div(id="sweep_graph", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+transfer_card = dbc.Card(
+    [
+        html.H3("Vote transfers"),
+        html.P(
+            "Percentage of each party's vote (rows) that goes to another party "
+            "(columns). Whatever a party doesn't pass on it keeps, as shown on "
+            "the shaded diagonal."
+        ),
+        dash_table.DataTable(
+            id="transfer_table",
+            columns=transfer_columns(year_data(default_year).engine),
+            data=transfer_rows(year_data(default_year).engine),
+            style_data_conditional=transfer_styles(year_data(default_year).engine),
+            editable=True,
+            style_cell={"textAlign": "center", "minWidth": "60px"},
+        ),
+        html.Div(id="transfer_graph", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+tactical_card = dbc.Card(
+    [
+        html.H3("Tactical voting"),
+        html.P(
+            "After the swings above, a share of the chosen parties' voters back "
+            "the runner-up in every seat where their own party is out of contention."
+        ),
+        html.Label("Parties voting tactically"),
+        dcc.Checklist(
+            id="tactical_parties",
+            options=outcome_options(year_data(default_year).engine, " "),
+            value=["LD", "Green"],
+            inline=True,
+        ),
+        html.Br(),
+        html.Label("Share of their vote that moves (%)"),
+        dcc.Slider(min=0, max=100, marks=markers, value=30, id="tactical_share"),
+        html.Div(id="tactical_graph", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
+)
+
+electoral_system_card = dbc.Card(
+    [
+        html.H3("First past the post vs proportional representation"),
+        html.P(
+            "Seats from the swings above, and what the same votes would give "
+            "under list PR in each region, with as many members as it has seats."
+        ),
+        dcc.RadioItems(
+            id="pr_method",
+            options=[
+                {"label": " D'Hondt", "value": "dhondt"},
+                {"label": " Sainte-Laguë", "value": "sainte_lague"},
+            ],
+            value="dhondt",
+            inline=True,
+        ),
+        html.Div(id="electoral_system_graph", children=[]),
+    ],
+    body=True,
+    style={"height": "100%"},
 )
 
 """
@@ -196,8 +701,24 @@ app.layout = dbc.Container(
             ],
         ),
         html.Br(),
+        dbc.Row([chloropleth_map]),
+        html.Br(),
+        dbc.Row([monte_carlo_card]),
+        html.Br(),
+        dbc.Row([marginal_seats_card]),
+        html.Br(),
+        dbc.Row([tipping_point_card]),
+        html.Br(),
+        dbc.Row([sensitivity_card]),
+        html.Br(),
+        dbc.Row([swing_sweep_card]),
+        html.Br(),
+        dbc.Row([transfer_card]),
+        html.Br(),
+        dbc.Row([tactical_card]),
+        html.Br(),
         dbc.Row(
-            [chloropleth_map],
+            [electoral_system_card],
             style={"margin-bottom": "25px"},
         ),
     ],
@@ -209,7 +730,11 @@ callback functions
 
 
 @app.callback(
-    Output("new_outcome_graph", "children"),
+    [
+        Output("new_outcome_graph", "children"),
+        Output("chloro_map", "figure"),
+        Output("session_id", "data"),
+    ],
     [
         Input("con_slider", "value"),
         Input("lab_slider", "value"),
@@ -217,10 +742,183 @@ callback functions
         Input("ld_slider", "value"),
         Input("green_slider", "value"),
         Input("pc_slider", "value"),
+        Input("year", "value"),
+    ],
+    [State("session_id", "data")],
+)
+def update_new_outcome(
+    con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing, year, session_id
+):
+
+    party_swings = slider_swings(
+        con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
+    )
+
+    if session_id is None:
+        session_id = uuid.uuid4().hex
+    with session_results_lock:
+        previous_year, previous = session_results.get(session_id, (None, None))
+    data = year_data(year)
+
+    # one swing calculation feeds the bar chart, the map and the tactical
+    # voting and electoral system charts; a single moved slider is applied
+    # on top of this session's previous result
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    if previous_year != year or len(triggered) != 1:
+        previous = None
+    result = swing_result(year, party_swings, previous)
+
+    with session_results_lock:
+        session_results[session_id] = (year, result)
+        session_results.move_to_end(session_id)
+        while len(session_results) > max_sessions:
+            session_results.popitem(last=False)
+
+    return (
+        plot_new_outcome(data, result),
+        # the names are sent whenever the year changes: the map starts with
+        # the default year's, and which year a browser's map shows can't be
+        # told from session_results, which another worker may hold
+        plot_new_choropleth(data, result, "year.value" in triggered),
+        session_id,
+    )
+
+
+def plot_new_outcome(data, result):
+
+    adjusted_winners_df = data.engine.seats_table(result)
+
+    graph = dcc.Graph(
+        id="new_winners_graph",
+        figure=go.Figure(
+            data=[
+                go.Bar(
+                    x=adjusted_winners_df["party"],
+                    y=adjusted_winners_df["seats_won"],
+                    marker=dict(color="rgb(248, 131, 121)"),
+                    width=0.9,
+                    orientation="v",
+                )
+            ],
+            layout=go.Layout(
+                height=500, margin={"l": 60, "r": 20, "b": 100, "t": 60, "pad": 0}
+            ),
+        ),
+    )
+
+    return graph
+
+
+def plot_new_choropleth(data, result, new_year=False):
+
+    # only the per-constituency colours change, and the names when the year
+    # does; the geometry stays in the browser
+    chloro_map = Patch()
+    chloro_map["data"][0]["z"] = map_z(
+        data, map_layer_index(data.engine.winning_parties(result))
+    ).tolist()
+    if new_year:
+        chloro_map["data"][0]["text"] = map_text(data).tolist()
+
+    return chloro_map
+
+
+@app.callback(
+    [
+        Output("winners_graph_div", "children"),
+        Output("target_party", "options"),
+        Output("target_party", "value"),
+        Output("target_seats", "max"),
+        Output("sensitivity_outcome", "options"),
+        Output("sensitivity_outcome", "value"),
+        Output("tactical_parties", "options"),
+        Output("tactical_parties", "value"),
+        Output("transfer_table", "columns"),
+        Output("transfer_table", "data"),
+        Output("transfer_table", "style_data_conditional"),
+    ],
+    [Input("year", "value")],
+    [
+        State("target_party", "value"),
+        State("sensitivity_outcome", "value"),
+        State("tactical_parties", "value"),
+    ],
+    prevent_initial_call=True,
+)
+def update_year_options(year, target_party, sensitivity_outcome, tactical_parties):
+
+    # each year has its own set of parties; choices they lack fall back to New
+    engine = year_data(year).engine
+
+    def keep(party):
+        return party if party in engine.outcome_index else "New"
+
+    return (
+        plot_the_winners(year),
+        outcome_options(engine),
+        keep(target_party),
+        len(engine.votes),
+        outcome_options(engine),
+        keep(sensitivity_outcome),
+        outcome_options(engine, " "),
+        [p for p in tactical_parties if p in engine.outcome_index],
+        transfer_columns(engine),
+        transfer_rows(engine),
+        transfer_styles(engine),
+    )
+
+
+@app.callback(
+    [
+        Output("chloro_map", "figure", allow_duplicate=True),
+        Output("map_detail_level", "data"),
+    ],
+    [Input("chloro_map", "relayoutData")],
+    [State("map_detail_level", "data")],
+    prevent_initial_call=True,
+)
+def update_map_detail(relayout_data, current_level):
+
+    # swap in coarser or finer boundaries only when the zoom crosses a level
+    if not relayout_data or "mapbox.zoom" not in relayout_data:
+        raise dash.exceptions.PreventUpdate
+    level = detail_level_for_zoom(relayout_data["mapbox.zoom"])
+    if level == current_level:
+        raise dash.exceptions.PreventUpdate
+
+    chloro_map = Patch()
+    chloro_map["data"][0]["geojson"] = boundary_urls[level]
+
+    return chloro_map, level
+
+
+@app.callback(
+    Output("mc_output", "children"),
+    [Input("mc_run", "n_clicks")],
+    [
+        State("con_slider", "value"),
+        State("lab_slider", "value"),
+        State("snp_slider", "value"),
+        State("ld_slider", "value"),
+        State("green_slider", "value"),
+        State("pc_slider", "value"),
+        State("mc_simulations", "value"),
+        State("mc_spread", "value"),
+        State("year", "value"),
     ],
+    prevent_initial_call=True,
 )
-def plot_new_outcome(
-    con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
+def plot_monte_carlo(
+    n_clicks,
+    con_swing,
+    lab_swing,
+    snp_swing,
+    ld_swing,
+    green_swing,
+    plaid_swing,
+    n_simulations,
+    spread,
+    year,
 ):
 
     party_swings = {
@@ -231,43 +929,86 @@ def plot_new_outcome(
         "Green": green_swing,
         "PC": plaid_swing,
     }
+    distributions = {p: ("normal", party_swings[p], spread) for p in party_swings}
+    data = year_data(year)
 
-    adjusted_winners_df = swing_to_new_party(ge_df, party_swings)
+    n_simulations = int(np.clip(n_simulations or 20000, min_simulations, max_simulations))
+    result = monte_carlo(
+        data.engine,
+        distributions,
+        n_simulations=n_simulations,
+        seed=0,
+        workers=monte_carlo_workers,
+    )
+    projection_df = seat_projection_table(result)
 
     graph = dcc.Graph(
-        id="new_winners_graph",
+        id="mc_graph",
         figure=go.Figure(
             data=[
                 go.Bar(
-                    x=adjusted_winners_df["party"],
-                    y=adjusted_winners_df["seats_won"],
+                    x=projection_df["party"],
+                    y=projection_df["mean_seats"],
+                    error_y=dict(
+                        type="data",
+                        symmetric=False,
+                        array=projection_df["high_seats"] - projection_df["mean_seats"],
+                        arrayminus=projection_df["mean_seats"] - projection_df["low_seats"],
+                    ),
                     marker=dict(color="rgb(248, 131, 121)"),
                     width=0.9,
                     orientation="v",
                 )
             ],
             layout=go.Layout(
-                height=500, margin={"l": 60, "r": 20, "b": 100, "t": 60, "pad": 0}
+                height=500,
+                yaxis=dict(title="Seats (mean, 5th-95th percentile)"),
+                margin={"l": 60, "r": 20, "b": 100, "t": 60, "pad": 0},
             ),
         ),
     )
 
-    return graph
+    majorities = [
+        html.Li("{}: {:.1%}".format(party, probability))
+        for party, probability in zip(
+            projection_df["party"], projection_df["majority_probability"]
+        )
+        if probability > 0
+    ]
+
+    # the seats whose winner is least certain across the simulations
+    uncertain = result.win_probability.max(axis=1).argsort()[:10]
+    uncertain_df = pd.DataFrame({
+        "Constituency": data.ge_df["Constituency"].to_numpy()[uncertain],
+        "Most likely winner": result.outcomes[result.win_probability[uncertain].argmax(axis=1)],
+        "Probability": result.win_probability[uncertain].max(axis=1).round(3),
+    })
+    uncertain_df = uncertain_df.replace({"Most likely winner": party_renaming_dict})
+
+    return [
+        graph,
+        html.H5("Probability of a majority"),
+        html.Ul(majorities or [html.Li("No party wins a majority")]),
+        html.H5("Least certain constituencies"),
+        dbc.Table.from_dataframe(uncertain_df, size="sm"),
+    ]
 
 
 @app.callback(
-    Output("chloro_map", "figure"),
+    Output("marginal_seats", "children"),
     [
+        Input("marginal_party", "value"),
         Input("con_slider", "value"),
         Input("lab_slider", "value"),
         Input("snp_slider", "value"),
         Input("ld_slider", "value"),
         Input("green_slider", "value"),
         Input("pc_slider", "value"),
+        Input("year", "value"),
     ],
 )
-def plot_new_choropleth(
-    con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
+def list_marginal_seats(
+    party, con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing, year
 ):
 
     party_swings = {
@@ -278,74 +1019,405 @@ def plot_new_choropleth(
         "Green": green_swing,
         "PC": plaid_swing,
     }
+    swing = party_swings[party]
+    data = year_data(year)
+
+    # answered from the precomputed thresholds, with no vote recalculation
+    n_flipped = len(data.flip_index.flips(party, swing))
+    marginal_df = data.flip_index.marginal_seats(party, 15)
+    marginal_df.insert(
+        0, "Constituency", marginal_df["Code"].map(data.constituency_names)
+    )
+    marginal_df = marginal_df.drop(columns="Code").round({"swing": 2})
+    marginal_df.columns = ["Constituency", "Swing needed (%)", "From", "To"]
+
+    return [
+        html.P(
+            "On its own, a {}% swing from {} changes the winner in {} seats.".format(
+                swing, party_renaming_dict.get(party, party), n_flipped
+            )
+        ),
+        dbc.Table.from_dataframe(marginal_df, size="sm"),
+    ]
+
+
+@app.callback(
+    Output("tipping_point", "children"),
+    [Input("target_run", "n_clicks")],
+    [
+        State("target_party", "value"),
+        State("target_direction", "value"),
+        State("target_seats", "value"),
+        State("target_swing_parties", "value"),
+        State("year", "value"),
+    ],
+    prevent_initial_call=True,
+)
+def find_tipping_point(n_clicks, party, direction, seats, swing_parties, year):
+
+    if not swing_parties or seats is None:
+        return html.P("Pick at least one party and a number of seats.")
+
+    engine = year_data(year).engine
+    target = SeatTarget(party, seats, direction == "at_least")
+    party_swings = minimal_swing(engine, target, swing_parties)
+    if party_swings is None:
+        return html.P("No swing from these parties reaches that target.")
+
+    result = engine.apply(party_swings)
+    seats_won = result.seats[engine.outcome_index[party]]
+
+    return [
+        html.Ul([
+            html.Li("{}: {:.2f}%".format(party_renaming_dict.get(p, p), s))
+            for p, s in party_swings.items()
+        ]),
+        html.P("{} then wins {} seats.".format(party_renaming_dict.get(party, party), seats_won)),
+    ]
+
+
+@app.callback(
+    Output("sensitivity_graph", "children"),
+    [
+        Input("sensitivity_x", "value"),
+        Input("sensitivity_y", "value"),
+        Input("sensitivity_outcome", "value"),
+        Input("year", "value"),
+    ],
+)
+def plot_sensitivity(party_x, party_y, outcome, year):
+
+    if party_x == party_y:
+        return html.P("Pick two different parties.")
+
+    # the whole grid is computed once per year and pair of parties and then cached
+    engine = year_data(year).engine
+    swings, seats = year_sensitivity_grid(year, party_x, party_y)
+    outcome_seats = seats[:, :, engine.outcome_index[outcome]]
+
+    graph = dcc.Graph(
+        id="sensitivity_heatmap",
+        figure=go.Figure(
+            data=[
+                go.Heatmap(
+                    x=swings,
+                    y=swings,
+                    z=outcome_seats.T,
+                    colorscale="Viridis",
+                    colorbar=dict(title="Seats"),
+                )
+            ],
+            layout=go.Layout(
+                height=600,
+                xaxis=dict(title="{} swing (%)".format(party_renaming_dict.get(party_x, party_x))),
+                yaxis=dict(title="{} swing (%)".format(party_renaming_dict.get(party_y, party_y))),
+                margin={"l": 60, "r": 20, "b": 60, "t": 40, "pad": 0},
+            ),
+        ),
+    )
+
+    return graph
+
+
+@app.callback(
+    Output("sweep_graph", "children"),
+    [Input("sweep_run", "n_clicks")],
+    [
+        State("sweep_party", "value"),
+        State("con_slider", "value"),
+        State("lab_slider", "value"),
+        State("snp_slider", "value"),
+        State("ld_slider", "value"),
+        State("green_slider", "value"),
+        State("pc_slider", "value"),
+        State("year", "value"),
+    ],
+    prevent_initial_call=True,
+)
+def plot_swing_sweep(
+    n_clicks,
+    party,
+    con_swing,
+    lab_swing,
+    snp_swing,
+    ld_swing,
+    green_swing,
+    plaid_swing,
+    year,
+):
 
-    colors_dict = {
-        'Con': '#0087DC',
-        'Lab': '#DC241f',
-        'SNP': '#f4f142',
-        'LD': '#FAA61A',
-        'Green': '#6AB023',
-        'PC': '#2f8c1a',
-        'New': '#a1edd8',
-        'other': '#bbbbbb',
+    party_swings = {
+        "C": con_swing,
+        "Lab": lab_swing,
+        "SNP": snp_swing,
+        "LD": ld_swing,
+        "Green": green_swing,
+        "PC": plaid_swing,
     }
 
-    party_json_list = make_party_json_list(ge_df, party_swings)
-    
-    data = go.Data([
-        go.Scattermapbox(
-            lat=['51.5'],
-            lon=['0'],
-            mode='markers',
+    # every frame comes from one batched calculation; frames carry only the
+    # bar heights and each constituency's colour, never the geometry
+    year_models = year_data(year)
+    swings, winners, seats = swing_sweep(year_models.engine, party, party_swings)
+    layers = map_z(year_models, map_layer_index(year_models.engine.outcomes)[winners])
+    party_names = [party_renaming_dict.get(p, p) for p in year_models.engine.outcomes]
+
+    frames = [
+        go.Frame(
+            name=str(swing),
+            data=[go.Bar(y=seats[i]), go.Choroplethmapbox(z=layers[i])],
+            traces=[0, 1],
         )
-    ])
+        for i, swing in enumerate(swings)
+    ]
+
+    data = [
+        go.Bar(
+            x=party_names,
+            y=seats[0],
+            marker=dict(color="rgb(248, 131, 121)"),
+            orientation="v",
+        ),
+        party_map_trace(year_models, layers[0]),
+    ]
 
     layout = go.Layout(
-        height=800,
-        autosize=True,
-        hovermode='closest',
-        legend = dict(
-            x=0.8,
-            y=0.5,
-            font=dict(
-                family='sans-serif',
-                size=12,
-                color='#000'
+        height=700,
+        xaxis=dict(domain=[0, 0.4]),
+        yaxis=dict(range=[0, seats.max() * 1.05], title="Seats"),
+        mapbox=dict(map_layout, domain=dict(x=[0.45, 1], y=[0, 1])),
+        margin={"l": 60, "r": 0, "b": 120, "t": 20, "pad": 4},
+        updatemenus=[
+            dict(
+                type="buttons",
+                showactive=False,
+                x=0,
+                y=-0.2,
+                buttons=[
+                    dict(
+                        label="Play",
+                        method="animate",
+                        args=[
+                            None,
+                            dict(
+                                frame=dict(duration=100, redraw=True),
+                                transition=dict(duration=0),
+                                fromcurrent=True,
+                            ),
+                        ],
+                    ),
+                    dict(
+                        label="Pause",
+                        method="animate",
+                        args=[[None], dict(frame=dict(duration=0), mode="immediate")],
+                    ),
+                ],
+            )
+        ],
+        sliders=[
+            dict(
+                x=0.1,
+                y=-0.1,
+                len=0.9,
+                currentvalue=dict(
+                    prefix="{} swing: ".format(party_renaming_dict.get(party, party)),
+                    suffix="%",
+                ),
+                steps=[
+                    dict(
+                        label=str(swing),
+                        method="animate",
+                        args=[
+                            [str(swing)],
+                            dict(mode="immediate", frame=dict(duration=0, redraw=True)),
+                        ],
+                    )
+                    for swing in swings
+                ],
+            )
+        ],
+    )
+
+    return dcc.Graph(
+        id="sweep_figure", figure=go.Figure(data=data, layout=layout, frames=frames)
+    )
+
+
+@app.callback(
+    [Output("transfer_graph", "children"), Output("transfer_table", "data", allow_duplicate=True)],
+    [Input("transfer_table", "data"), Input("year", "value")],
+    prevent_initial_call="initial_duplicate",
+)
+def plot_transfers(rows, year):
+
+    # the whole table is one matrix product over the constituency vote matrix;
+    # rows left from another year's parties are ignored, and so is the
+    # diagonal, which is filled in with what each party keeps
+    engine = year_data(year).engine
+    flows = {
+        row["party"]: {q: row.get(q) or 0 for q in engine.outcomes if q != row["party"]}
+        for row in rows
+        if row["party"] in engine.outcome_index
+    }
+    try:
+        result = engine.apply_transfers(flows)
+    except ValueError as e:
+        return html.P(str(e)), dash.no_update
+
+    kept = np.round(np.diag(result.transfers) * 100, 2)
+    filled = [
+        dict(row, **{row["party"]: kept[engine.outcome_index[row["party"]]]})
+        if row["party"] in engine.outcome_index
+        else row
+        for row in rows
+    ]
+
+    party_names = [party_renaming_dict.get(p, p) for p in engine.outcomes]
+    baseline = engine.apply({})
+
+    graph = dcc.Graph(
+        id="transfer_seats_graph",
+        figure=go.Figure(
+            data=[
+                go.Bar(
+                    name=str(year),
+                    x=party_names,
+                    y=baseline.seats,
+                    marker=dict(color="rgb(200, 200, 200)"),
+                ),
+                go.Bar(
+                    name="After transfers",
+                    x=party_names,
+                    y=result.seats,
+                    marker=dict(color="rgb(248, 131, 121)"),
+                ),
+            ],
+            layout=go.Layout(
+                height=500,
+                barmode="group",
+                margin={"l": 60, "r": 20, "b": 100, "t": 60, "pad": 0},
             ),
-            bgcolor='#E2E2E2',
         ),
-        mapbox=dict(
-            layers=[
-                dict(
-                    sourcetype = 'geojson',
-                    source = party_json_list[i],
-                    type = 'fill',
-                    color = colors_dict[list(colors_dict.keys())[i]],
-                    opacity=0.6,
-                    name=list(colors_dict.keys())[i]
-                ) for i in range(len(party_json_list))
-            ],
+    )
 
-            accesstoken=mapbox_access_token,
-            bearing=0,
-            center=dict(
-                lat=53,
-                lon=0,
-            ),
-            pitch=0,
-            zoom=5.,
-            style='dark',
+    return graph, (filled if filled != rows else dash.no_update)
 
+
+@app.callback(
+    Output("tactical_graph", "children"),
+    [
+        Input("tactical_parties", "value"),
+        Input("tactical_share", "value"),
+        Input("con_slider", "value"),
+        Input("lab_slider", "value"),
+        Input("snp_slider", "value"),
+        Input("ld_slider", "value"),
+        Input("green_slider", "value"),
+        Input("pc_slider", "value"),
+        Input("year", "value"),
+    ],
+)
+def plot_tactical_voting(
+    parties,
+    share,
+    con_swing,
+    lab_swing,
+    snp_swing,
+    ld_swing,
+    green_swing,
+    plaid_swing,
+    year,
+):
+
+    party_swings = slider_swings(
+        con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
+    )
+
+    engine = year_data(year).engine
+    tactical = {p: share for p in parties if p in engine.outcome_index}
+    base = swing_result(year, party_swings)
+    result = engine.apply_tactical(tactical, base)
+    party_names = [party_renaming_dict.get(p, p) for p in engine.outcomes]
+
+    graph = dcc.Graph(
+        id="tactical_seats_graph",
+        figure=go.Figure(
+            data=[
+                go.Bar(
+                    name="Swing only",
+                    x=party_names,
+                    y=base.seats,
+                    marker=dict(color="rgb(200, 200, 200)"),
+                ),
+                go.Bar(
+                    name="With tactical voting",
+                    x=party_names,
+                    y=result.seats,
+                    marker=dict(color="rgb(248, 131, 121)"),
+                ),
+            ],
+            layout=go.Layout(
+                height=500,
+                barmode="group",
+                margin={"l": 60, "r": 20, "b": 100, "t": 60, "pad": 0},
+            ),
         ),
-        margin={'l': 0, 'r': 0, 'b': 0, 't': 20, 'pad': 4}
     )
 
-    chloro_map = go.Figure(
-        data=data,
-        layout=layout
+    return graph
+
+
+@app.callback(
+    Output("electoral_system_graph", "children"),
+    [
+        Input("pr_method", "value"),
+        Input("con_slider", "value"),
+        Input("lab_slider", "value"),
+        Input("snp_slider", "value"),
+        Input("ld_slider", "value"),
+        Input("green_slider", "value"),
+        Input("pc_slider", "value"),
+        Input("year", "value"),
+    ],
+)
+def plot_electoral_systems(
+    method, con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing, year
+):
+
+    party_swings = slider_swings(
+        con_swing, lab_swing, snp_swing, ld_swing, green_swing, plaid_swing
     )
 
-    return chloro_map
+    data = year_data(year)
+    result = swing_result(year, party_swings)
+    party_names = [party_renaming_dict.get(p, p) for p in data.engine.outcomes]
+
+    graph = dcc.Graph(
+        id="electoral_system_seats_graph",
+        figure=go.Figure(
+            data=[
+                go.Bar(
+                    name="First past the post",
+                    x=party_names,
+                    y=result.seats,
+                    marker=dict(color="rgb(248, 131, 121)"),
+                ),
+                go.Bar(
+                    name="Regional list PR",
+                    x=party_names,
+                    y=data.regional_pr.seats(result, method),
+                    marker=dict(color="rgb(121, 170, 248)"),
+                ),
+            ],
+            layout=go.Layout(
+                height=500,
+                barmode="group",
+                margin={"l": 60, "r": 20, "b": 100, "t": 60, "pad": 0},
+            ),
+        ),
+    )
+
+    return graph
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""
+Timings for the data loading and swing calculations.
+
+Run from the repository root with: python benchmarks.py
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from df_wrangling import (
+    clean_df,
+    load_results,
+    read_results,
+    results_path,
+    swing_to_new_party,
+    SwingEngine,
+)
+from test_df_wrangling import pivot_clean_df
+
+slider_parties = ["C", "Lab", "SNP", "LD", "Green", "PC"]
+
+
+def best_of(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(name, seconds):
+    print("{:<48} {:>10.2f} ms".format(name, seconds * 1000))
+
+
+def bench_clean_df():
+    raw_df = read_results(results_path)
+
+    pivot_time = best_of(lambda: pivot_clean_df(raw_df))
+    array_time = best_of(lambda: clean_df(raw_df))
+
+    report("clean_df: pivot_table + merge", pivot_time)
+    report("clean_df: factorize + maximum.at", array_time)
+    print("{:<48} {:>10.1f} x".format("speed-up", pivot_time / array_time))
+
+
+def bench_startup():
+    # make sure the cache exists before timing it
+    load_results()
+
+    xls_time = best_of(lambda: clean_df(pd.read_excel(results_path)))
+    typed_time = best_of(lambda: clean_df(read_results(results_path)))
+    cached_time = best_of(load_results)
+
+    report("startup: read_excel + clean_df", xls_time)
+    report("startup: read_results + clean_df", typed_time)
+    report("startup: load_results (cached)", cached_time)
+    print("{:<48} {:>10.1f} x".format("speed-up", xls_time / cached_time))
+
+
+def bench_ingestion():
+    # memory held by the raw rows before clean_df reduces them
+    for name, raw_df in [
+        ("read_excel", pd.read_excel(results_path)),
+        ("read_results", read_results(results_path)),
+    ]:
+        megabytes = raw_df.memory_usage(deep=True).sum() / 2 ** 20
+        print("{:<48} {:>10.2f} MB".format("raw rows: " + name, megabytes))
+
+
+def bench_batch(n_scenarios=2000):
+    ge_df = load_results()
+    engine = SwingEngine(ge_df)
+    swings = np.random.default_rng(0).integers(0, 101, (n_scenarios, len(slider_parties)))
+    scenarios = [dict(zip(slider_parties, row.tolist())) for row in swings]
+
+    # the DataFrame version is slow, so time a slice and scale it up
+    sample = scenarios[:100]
+    loop_time = best_of(
+        lambda: [swing_to_new_party(ge_df, s) for s in sample], repeat=1
+    ) * n_scenarios / len(sample)
+    apply_time = best_of(lambda: [engine.apply(s) for s in scenarios], repeat=3)
+    batch_time = best_of(lambda: engine.seats_batch(swings, slider_parties), repeat=3)
+
+    name = "{} scenarios: ".format(n_scenarios)
+    report(name + "swing_to_new_party loop", loop_time)
+    report(name + "SwingEngine.apply loop", apply_time)
+    report(name + "SwingEngine.seats_batch", batch_time)
+
+
+if __name__ == "__main__":
+    bench_startup()
+    bench_ingestion()
+    bench_clean_df()
+    bench_batch()
@@ -1,6 +1,27 @@
 import pandas as pd
 import numpy as np
-import json
+import os
+import gzip
+import hashlib
+import struct
+import zipfile
+import argparse
+import warnings
+import xlrd
+from collections import namedtuple
+from pandas.api.types import union_categoricals
+
+from geometry import (
+    boundaries_path,
+    detail_levels,
+    detail_level_geojson,
+    flatten_topology,
+    GeometryStore,
+    load_boundaries,
+    load_geometry,
+    load_topology,
+    replace_file,
+)
 
 mapbox_access_token = "enter-your-token-here"
 
@@ -19,13 +40,124 @@ party_abbreviations_dict = {
 party_renaming_dict = party_abbreviations_dict.copy()
 del party_renaming_dict['Green']
 
-with open('./data/parliamentary_boundaries.json') as f:
-    geojson_data = json.load(f)
-    
-    
-def clean_df(ge_df):
+# parties drawn as their own map layer, in layer order; everyone else is "other"
+map_layer_parties = {
+    party: layer for layer, party in enumerate(['C', 'Lab', 'SNP', 'LD', 'Green', 'PC', 'New'])
+}
+
+# the per-constituency columns clean_df keeps ahead of the party vote columns
+constituency_columns = [
+    'Year',
+    'Code',
+    'Constituency',
+    'Region',
+    'Total constituency votes',
+    'Majority Party',
+    'Majority',
+    'Majority %',
+]
+
+results_path = './data/2017_General_Election_Results.xls'
+
+# every results workbook; each holds one or more election years
+results_paths = [results_path]
+
+# the workbook columns clean_df uses, and the compact dtype each is read as;
+# the per-seat columns are blank on all but the winner's row, so stay float,
+# and votes are nullable so a blank cell reads as missing rather than failing
+results_dtypes = {
+    'Year': 'int16',
+    'Code': 'category',
+    'Constituency': 'category',
+    'Region': 'category',
+    'Party Abbreviation': 'category',
+    'Candidate Votes': 'Int32',
+    'Total constituency votes': 'float64',
+    'Majority Party': 'category',
+    'Majority': 'float64',
+    'Majority %': 'float64',
+}
+
+# rows of a parsed sheet converted to typed columns at a time
+max_chunk_rows = 4096
+
+
+def __getattr__(name):
+    # geojson_data used to be parsed at import; keep the name, but load on
+    # first use and keep it, as load_boundaries does
+    if name == 'geojson_data':
+        return load_boundaries()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def iter_results(paths=results_path, years=None, chunk_rows=max_chunk_rows):
+    """Read results rows a chunk at a time, with only the columns clean_df uses.
+
+    paths is a workbook or a list of them; every sheet with the results
+    columns is read, and only rows for years (all years if None) are kept.
+    Yields one DataFrame of results_dtypes per chunk.
+
+    xlrd can only parse a whole .xls sheet, so memory isn't bounded by the
+    chunk size: one sheet is parsed at a time and unloaded before the next,
+    and chunk_rows only bounds the untyped copy of each column made while
+    converting it.
+    """
+    for path in [paths] if isinstance(paths, str) else paths:
+        workbook = xlrd.open_workbook(path, on_demand=True)
+        try:
+            for name in workbook.sheet_names():
+                sheet = workbook.sheet_by_name(name)
+                header = sheet.row_values(0) if sheet.nrows else []
+                if set(results_dtypes) <= set(header):
+                    yield from _sheet_chunks(sheet, header, years, chunk_rows)
+                workbook.unload_sheet(name)
+        finally:
+            workbook.release_resources()
+
+
+def _sheet_chunks(sheet, header, years, chunk_rows):
+    for start in range(1, sheet.nrows, chunk_rows):
+        end = min(start + chunk_rows, sheet.nrows)
+        year = pd.to_numeric(sheet.col_values(header.index('Year'), start, end), errors='coerce')
+        keep = np.isin(year, years) if years is not None else ~np.isnan(year)
+        if not keep.any():
+            continue
+
+        chunk = {}
+        for column, dtype in results_dtypes.items():
+            values = np.array(sheet.col_values(header.index(column), start, end), dtype=object)[keep]
+            # empty cells come back as ''
+            values[values == ''] = np.nan
+            if dtype == 'category':
+                chunk[column] = pd.Categorical(values)
+            else:
+                chunk[column] = pd.Series(pd.to_numeric(values)).astype(dtype)
+        yield pd.DataFrame(chunk)
+
+
+def read_results(paths=results_path, years=None, chunk_rows=max_chunk_rows):
+    """All the chunks from iter_results as one compactly typed DataFrame.
+
+    Every kept row is held at once, though only in the compact dtypes.
+    """
+    chunks = list(iter_results(paths, years, chunk_rows))
+    if not chunks:
+        return pd.DataFrame({c: pd.Series(dtype=d) for c, d in results_dtypes.items()})
+
+    columns = {}
+    for column, dtype in results_dtypes.items():
+        if dtype == 'category':
+            columns[column] = union_categoricals(
+                [chunk[column] for chunk in chunks], sort_categories=True
+            )
+        else:
+            columns[column] = pd.concat([chunk[column] for chunk in chunks], ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+def clean_df(ge_df, year=2017):
     
-    ge_df = ge_df.loc[ge_df['Year']==2017]
+    ge_df = ge_df.loc[ge_df['Year']==year]
     
     #remove the parties that didn't win a seat
     winning_parties = ge_df['Majority Party'].unique()
@@ -35,26 +167,199 @@ def clean_df(ge_df):
     general_constituency_info = ge_df.drop_duplicates('Constituency', keep='first')
     general_constituency_info = general_constituency_info.drop(
         ['Party Abbreviation','Party','Candidate Votes','Share of Vote'],
-        axis=1
+        axis=1,
+        errors='ignore',
     )
     
-    df_votes = ge_df[['Code','Party Abbreviation','Candidate Votes']]
-    df_votes = df_votes.pivot_table(
-        index='Code', 
-        columns='Party Abbreviation', 
-        values='Candidate Votes', 
-        aggfunc=max,
-    ).fillna(0).reset_index()
-    
-    df_new = pd.merge(
-        general_constituency_info,
-        df_votes,
-        how='outer',
-        on='Code'
+    #one row per constituency and one column per party, both sorted, with
+    #each candidate's votes scattered in; the largest is kept if a party
+    #stood twice in a seat, and parties that didn't stand (or whose votes
+    #are blank) get 0
+    code_index, codes = pd.factorize(ge_df['Code'], sort=True)
+    party_index, parties = pd.factorize(ge_df['Party Abbreviation'], sort=True)
+    votes = np.full((len(codes), len(parties)), -np.inf)
+    np.fmax.at(
+        votes,
+        (code_index, party_index),
+        ge_df['Candidate Votes'].to_numpy(dtype=float, na_value=np.nan),
+    )
+    votes[votes == -np.inf] = 0
+
+    #each constituency's information, in the same sorted order
+    info_codes = general_constituency_info['Code']
+    if info_codes.duplicated().any():
+        raise ValueError("Codes with more than one constituency: {}".format(
+            ', '.join(map(str, info_codes[info_codes.duplicated()].unique()))
+        ))
+    info_rows = pd.Index(info_codes).get_indexer(codes)
+    if (info_rows < 0).any():
+        raise ValueError("Codes with no constituency: {}".format(
+            ', '.join(map(str, codes[info_rows < 0]))
+        ))
+    general_constituency_info = general_constituency_info.iloc[info_rows]
+
+    df_new = pd.concat(
+        [
+            general_constituency_info.reset_index(drop=True),
+            pd.DataFrame(votes, columns=np.asarray(parties)),
+        ],
+        axis=1,
     )
     
     return df_new
-    
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def partition_path(path, year):
+    return '{}.{}.clean.npz'.format(os.path.splitext(path)[0], year)
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.years.npz'
+
+
+# bumped whenever a cached partition's layout or clean_df's output changes,
+# so caches written by an older version are rebuilt rather than reused
+results_cache_version = 2
+
+
+def _read_cache(cache_path, path):
+    """A cache's arrays, if it was written by this version from path as it is.
+
+    Returns None for a cache that is missing, unreadable or stale. One that
+    matches on content hash but not mtime (after a checkout, say) is
+    restamped with the new mtime, so the next start doesn't hash again.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            arrays = {key: cache[key] for key in cache.files}
+    except unreadable_cache_errors:
+        return None
+
+    if arrays.get('version') != results_cache_version:
+        return None
+    mtime = os.stat(path).st_mtime_ns
+    if arrays['source_mtime'] != mtime:
+        if arrays['source_sha1'] != file_sha1(path):
+            return None
+        arrays['source_mtime'] = np.int64(mtime)
+        _write_cache(cache_path, arrays)
+    return arrays
+
+
+# what reading a cache that is truncated, half-written or from an older
+# layout can raise; any of them just means the cache is rebuilt
+unreadable_cache_errors = (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile)
+
+
+def _write_cache(cache_path, arrays):
+    # processes building the same cache at once never see a partial file
+    with replace_file(cache_path) as f:
+        np.savez(f, **arrays)
+
+
+def build_partitions(path=results_path):
+    """Clean every year in the workbook and cache each one as its own .npz.
+
+    The workbook is read once. Each year's partition, and an index of the
+    years, sits next to the workbook and is reused while the source has
+    the same mtime or content hash. Returns {year: cleaned frame}.
+    """
+    source = {
+        'version': np.int64(results_cache_version),
+        'source_mtime': np.int64(os.stat(path).st_mtime_ns),
+        'source_sha1': np.array(file_sha1(path)),
+    }
+    raw_df = read_results(path)
+
+    partitions = {}
+    for year in sorted(raw_df['Year'].unique()):
+        arrays = dict(source, **_frame_arrays(clean_df(raw_df, year)))
+        _write_cache(partition_path(path, year), arrays)
+        # the same frame a later load gets back from the cache
+        partitions[int(year)] = _frame_from_cache(arrays)
+
+    _write_cache(index_path(path), dict(source, years=np.array(list(partitions))))
+
+    return partitions
+
+
+def results_years(path=results_path):
+    """Election years in the workbook, from its index once it has been built."""
+    index = _read_cache(index_path(path), path)
+    if index is not None:
+        return index['years'].tolist()
+    return list(build_partitions(path))
+
+
+def results_catalogue(paths=None):
+    # {year: workbook} over every results file, later files winning
+    catalogue = {}
+    for path in results_paths if paths is None else paths:
+        for year in results_years(path):
+            catalogue[year] = path
+    return dict(sorted(catalogue.items()))
+
+
+def load_results(path=results_path, year=2017):
+    """One year's results through clean_df, from its cached partition.
+
+    Only the requested year is read from disk; the workbook itself is read
+    (and every partition rebuilt) only when the cache is missing or stale.
+    """
+    ge_df = _load_partition(path, year)
+    if ge_df is None:
+        # a stale index rebuilds every partition, so check the year first
+        if year not in results_years(path):
+            raise KeyError("no {} results in {}".format(year, path))
+        ge_df = _load_partition(path, year)
+    if ge_df is None:
+        ge_df = build_partitions(path)[year]
+
+    return ge_df
+
+
+def _load_partition(path, year):
+    cache = _read_cache(partition_path(path, year), path)
+    if cache is None:
+        # missing, unreadable or stale; rewritten by the rebuild
+        return None
+    return _frame_from_cache(cache)
+
+
+def _frame_arrays(ge_df, prefix=''):
+    arrays = {prefix + 'columns': np.array(ge_df.columns, dtype=str)}
+    for i, column in enumerate(ge_df.columns):
+        values = ge_df[column]
+        if values.dtype.kind in 'biuf':
+            arrays['{}col_{}'.format(prefix, i)] = values.to_numpy()
+        else:
+            # strings are stored fixed-width so the cache loads without pickle
+            isna = values.isna().to_numpy()
+            values = values.to_numpy(dtype=object)
+            arrays['{}col_{}'.format(prefix, i)] = np.where(isna, '', values).astype(str)
+            arrays['{}isna_{}'.format(prefix, i)] = isna
+    return arrays
+
+
+def _frame_from_cache(cache, prefix=''):
+    columns = {}
+    for i, column in enumerate(cache[prefix + 'columns']):
+        values = cache['{}col_{}'.format(prefix, i)]
+        if '{}isna_{}'.format(prefix, i) in cache:
+            isna = cache['{}isna_{}'.format(prefix, i)]
+            values = pd.Series(values.astype(object)).mask(isna)
+        columns[str(column)] = values
+    return pd.DataFrame(columns)
 
 
 def identify_the_winners(ge_df):
@@ -65,44 +370,296 @@ def identify_the_winners(ge_df):
     return ge_winners_df
 
 
-def swing_to_new_party(ge_df, party_swings):
+def party_columns(ge_df):
+    return [c for c in ge_df.columns if c not in constituency_columns and c != 'New']
 
-    new_votes = {}
-    new_party = []
-    for p in party_swings:
-        
-        new_votes[p] = ge_df[p] * (1-(party_swings[p]/100))
-        new_party += [(ge_df[p] * (party_swings[p]/100)).values]
-        
-    
-    new_votes_df = ge_df.copy()
-    for p in new_votes:
-        new_votes_df[p] = new_votes[p]
-        
-    new_votes_df["New"] = np.array(new_party).sum(axis=0)
 
-    adjusted_winners_df = new_votes_df.iloc[:,8:].idxmax(axis=1).value_counts().reset_index()
-    adjusted_winners_df.columns = ['party','seats_won']
-    adjusted_winners_df = adjusted_winners_df.replace({'party': party_renaming_dict})
+# size of each (scenarios x constituencies) working array in batched
+# calculations; small enough to stay in cache
+max_chunk_bytes = 256 * 2 ** 10
+
+
+def count_seats(winners, n_outcomes):
+    # seats per outcome for each row of a (scenarios x constituencies) array
+    offsets = np.arange(len(winners))[:, None] * n_outcomes
+    counts = np.bincount((winners + offsets).ravel(), minlength=len(winners) * n_outcomes)
+    return counts.reshape(len(winners), n_outcomes)
+
+
+SwingResult = namedtuple('SwingResult', ['swing', 'votes', 'winners', 'seats', 'new_votes'])
+# as SwingResult, but from apply_transfers: it holds the outcome x outcome
+# transfer matrix instead of a swing, so it can't be passed to update
+TransferResult = namedtuple('TransferResult', ['transfers', 'votes', 'winners', 'seats', 'new_votes'])
+
+
+class SwingEngine:
+    """Constituency x party vote matrix for repeated swing calculations.
+
+    Built once from the output of clean_df. Applying a swing is one
+    broadcasted multiply over the matrix; no DataFrame is copied.
+    """
+
+    def __init__(self, ge_df):
+        parties = party_columns(ge_df)
+        self._set_matrix(parties, ge_df['Code'].to_numpy(), ge_df[parties].to_numpy(dtype=float))
+
+    @classmethod
+    def from_matrix(cls, parties, codes, votes):
+        # as built from clean_df, but from an already extracted vote matrix
+        engine = cls.__new__(cls)
+        engine._set_matrix(list(parties), np.asarray(codes), votes)
+        return engine
+
+    def _set_matrix(self, parties, codes, votes):
+        self.parties = parties
+        self.party_index = {p: i for i, p in enumerate(self.parties)}
+        self.outcomes = np.array(self.parties + ['New'], dtype=object)
+        self.outcome_index = {p: i for i, p in enumerate(self.outcomes)}
+        self.codes = codes
+        self.votes = np.ascontiguousarray(votes, dtype=float)
+        # party-major copy for the batched scenarios
+        self.party_votes = np.ascontiguousarray(self.votes.T)
+        # every outcome's votes, with the new party starting on none
+        self.outcome_votes = np.zeros((len(self.votes), len(self.outcomes)))
+        self.outcome_votes[:, :-1] = self.votes
+
+    def swing_vector(self, party_swings):
+        # a party that stood nowhere this year has no votes to swing, so its
+        # swing is left out rather than refused
+        swing = np.zeros(len(self.parties))
+        for p in party_swings:
+            if p in self.party_index:
+                swing[self.party_index[p]] = party_swings[p] / 100
+        return swing
+
+    def new_party_votes(self, swing):
+        # summed party by party in column order, as winners_batch does, so
+        # every path gets bit-identical totals and breaks exact ties the same way
+        new_votes = np.zeros(len(self.votes))
+        for p in np.flatnonzero(swing):
+            new_votes += self.votes[:, p] * swing[p]
+        return new_votes
+
+    def apply(self, party_swings):
+        swing = self.swing_vector(party_swings)
+
+        # the last column holds the votes won by the new party
+        new_votes = np.empty((len(self.votes), len(self.parties) + 1))
+        np.multiply(self.votes, 1 - swing, out=new_votes[:, :-1])
+        new_votes[:, -1] = self.new_party_votes(swing)
+
+        winners = new_votes.argmax(axis=1)
+        seats = np.bincount(winners, minlength=len(self.outcomes))
+
+        return SwingResult(swing, new_votes, winners, seats, new_votes[:, -1])
+
+    def update(self, previous, party_swings):
+        """Apply party_swings starting from the previous result.
+
+        When only one party's swing has changed, only that party's column and
+        the new party's column are recalculated, and the winner is re-checked
+        only where one of them held or can now reach the lead. Results are
+        identical to apply, which is used when several swings changed.
+        """
+        swing = self.swing_vector(party_swings)
+        changed = np.flatnonzero(swing != previous.swing)
+        if len(changed) == 0:
+            return previous
+        if len(changed) > 1:
+            return self.apply(party_swings)
+        p = changed[0]
+
+        new_votes = previous.votes.copy()
+        new_votes[:, p] = self.votes[:, p] * (1 - swing[p])
+        # recalculated rather than adjusted, so it matches apply exactly and
+        # exact ties (e.g. a 50% swing) are broken the same way
+        new_votes[:, -1] = self.new_party_votes(swing)
+
+        # elsewhere the leader's votes are untouched and nobody else moved up
+        leader_votes = previous.votes[np.arange(len(new_votes)), previous.winners]
+        recheck = np.maximum(new_votes[:, p], new_votes[:, -1]) >= leader_votes
+        recheck |= (previous.winners == p) | (previous.winners == len(self.parties))
+        winners = previous.winners.copy()
+        winners[recheck] = new_votes[recheck].argmax(axis=1)
+        seats = np.bincount(winners, minlength=len(self.outcomes))
+
+        return SwingResult(swing, new_votes, winners, seats, new_votes[:, -1])
+
+    def transfer_matrix(self, flows):
+        """Outcome x outcome matrix of the share of votes each party keeps or passes on.
 
-    return adjusted_winners_df
+        flows maps a party to {receiving party: percentage of its votes}, and
+        any party or New can receive. Whatever a party doesn't pass on it keeps.
+        """
+        n_outcomes = len(self.outcomes)
+        transfers = np.zeros((n_outcomes, n_outcomes))
+        for from_party, to_parties in flows.items():
+            i = self.outcome_index[from_party]
+            for to_party, percentage in to_parties.items():
+                if percentage < 0 or percentage > 100:
+                    raise ValueError(
+                        "transfer from {} to {} must be between 0 and 100%".format(
+                            from_party, to_party
+                        )
+                    )
+                if to_party != from_party:
+                    transfers[i, self.outcome_index[to_party]] += percentage / 100
+
+        passed_on = transfers.sum(axis=1)
+        if (passed_on > 1 + 1e-9).any():
+            raise ValueError(
+                "{} would pass on more than 100% of their votes".format(
+                    ", ".join(self.outcomes[passed_on > 1 + 1e-9])
+                )
+            )
+        transfers[np.diag_indices(n_outcomes)] = np.clip(1 - passed_on, 0, None)
+
+        return transfers
+
+    def apply_transfers(self, flows):
+        """Move votes between any pair of parties in every constituency at once.
+
+        The new vote matrix is one product of the outcome vote matrix with
+        transfer_matrix(flows), returned as a TransferResult. A swing to the
+        new party is the special case {p: {'New': swing}}, giving the same
+        votes as apply up to rounding.
+        """
+        transfers = self.transfer_matrix(flows)
+
+        new_votes = self.outcome_votes @ transfers
+        winners = new_votes.argmax(axis=1)
+        seats = np.bincount(winners, minlength=len(self.outcomes))
+
+        return TransferResult(transfers, new_votes, winners, seats, new_votes[:, -1])
+
+    def apply_tactical(self, tactical, base=None):
+        """Tactical voting on top of a swing to the new party.
+
+        tactical maps a party to the percentage of its vote that, in every
+        seat where it is neither leading nor second, moves to whoever is
+        second. base is the SwingResult of the swing it goes on top of (no
+        swing if None); the leader and runner-up of every seat are found
+        together across its whole vote matrix.
+        """
+        if base is None:
+            base = self.apply({})
+        rows = np.arange(len(base.votes))
+
+        # the runner-up is the leader once the winner's column is knocked out;
+        # ties for second go to the earlier column, as argmax breaks them
+        incumbent = base.winners
+        others = base.votes.copy()
+        others[rows, incumbent] = -1
+        challenger = others.argmax(axis=1)
+
+        new_votes = base.votes.copy()
+        moved = np.zeros(len(rows))
+        for p in tactical:
+            i = self.outcome_index[p]
+            moving = base.votes[:, i] * (tactical[p] / 100)
+            moving[(incumbent == i) | (challenger == i)] = 0
+            new_votes[:, i] -= moving
+            moved += moving
+        new_votes[rows, challenger] += moved
+
+        winners = new_votes.argmax(axis=1)
+        seats = np.bincount(winners, minlength=len(self.outcomes))
+
+        return SwingResult(base.swing, new_votes, winners, seats, new_votes[:, -1])
+
+    def swing_matrix(self, swings, parties=None):
+        # (scenarios x parties) percentages -> fractions over the full party axis
+        swings = np.atleast_2d(np.asarray(swings, dtype=float))
+        if parties is None:
+            parties = self.parties
+        # parties that stood nowhere are left out, as in swing_vector
+        present = [i for i, p in enumerate(parties) if p in self.party_index]
+        swing = np.zeros((len(swings), len(self.parties)))
+        swing[:, [self.party_index[parties[i]] for i in present]] = swings[:, present] / 100
+        return swing
+
+    def winners_batch(self, swings, parties=None, chunk_size=None):
+        """Winner of every constituency under many swing scenarios.
+
+        swings is a (scenarios x len(parties)) array of percentage swings;
+        parties defaults to self.parties. Scenarios are evaluated a chunk at
+        a time, keeping a running leader across the party columns so each
+        working array stays within max_chunk_bytes. Winners are the same as
+        apply gives. Yields (first scenario, chunk x constituencies winner
+        indices) pairs.
+        """
+        swing = self.swing_matrix(swings, parties)
+        n_parties, n_seats = self.party_votes.shape
+        if chunk_size is None:
+            chunk_size = max(1, max_chunk_bytes // (n_seats * 8))
+
+        for start in range(0, len(swing), chunk_size):
+            chunk = swing[start:start + chunk_size]
+            kept = 1 - chunk
+
+            leader_votes = np.multiply.outer(kept[:, 0], self.party_votes[0])
+            winners = np.zeros(leader_votes.shape, dtype=np.intp)
+            new_votes = np.zeros(leader_votes.shape)
+            for p in range(n_parties):
+                if p:
+                    # strictly greater, so ties go to the earlier column like argmax
+                    party_votes = np.multiply.outer(kept[:, p], self.party_votes[p])
+                    np.putmask(winners, party_votes > leader_votes, p)
+                    np.maximum(leader_votes, party_votes, out=leader_votes)
+                if chunk[:, p].any():
+                    new_votes += np.multiply.outer(chunk[:, p], self.party_votes[p])
+            np.putmask(winners, new_votes > leader_votes, n_parties)
+
+            yield start, winners
+
+    def seats_batch(self, swings, parties=None, chunk_size=None):
+        """Seat counts for many swing scenarios in one call.
+
+        Returns a (scenarios x len(self.outcomes)) array of seats won.
+        """
+        n_outcomes = len(self.outcomes)
+        seats = np.empty((len(np.atleast_2d(swings)), n_outcomes), dtype=int)
+        for start, winners in self.winners_batch(swings, parties, chunk_size):
+            seats[start:start + len(winners)] = count_seats(winners, n_outcomes)
+        return seats
+
+    def winning_parties(self, result):
+        return self.outcomes[result.winners]
+
+    def seats_table(self, result):
+        # same ordering as value_counts: most seats first, ties by first win
+        parties, first_win = np.unique(result.winners, return_index=True)
+        parties = parties[np.argsort(first_win)]
+        parties = parties[np.argsort(-result.seats[parties], kind='stable')]
+
+        adjusted_winners_df = pd.DataFrame({
+            'party': self.outcomes[parties],
+            'seats_won': result.seats[parties],
+        })
+        adjusted_winners_df = adjusted_winners_df.replace({'party': party_renaming_dict})
+
+        return adjusted_winners_df
+
+
+def swing_to_new_party(ge_df, party_swings):
+
+    engine = SwingEngine(ge_df)
+
+    return engine.seats_table(engine.apply(party_swings))
     
     
+def swing_to_new_party_batch(ge_df, swings, parties=None, chunk_size=None):
+
+    return SwingEngine(ge_df).seats_batch(swings, parties, chunk_size)
+
+
 def recalculate_votes(ge_df, party_swings):
 
-    new_votes = {}
-    new_party = []
-    for p in party_swings:
-        
-        new_votes[p] = ge_df[p] * (1-(party_swings[p]/100))
-        new_party += [(ge_df[p] * (party_swings[p]/100)).values]
-        
-    
+    engine = SwingEngine(ge_df)
+    result = engine.apply(party_swings)
+
     new_votes_df = ge_df.copy()
-    for p in new_votes:
-        new_votes_df[p] = new_votes[p]
-        
-    new_votes_df["New"] = np.array(new_party).sum(axis=0)
+    new_votes_df[list(engine.outcomes)] = result.votes
 
     return new_votes_df
 
@@ -110,65 +667,284 @@ def recalculate_votes(ge_df, party_swings):
 
 def make_party_json_list(ge_df,  party_swings):
 
-    adjusted_winners_df = recalculate_votes(ge_df, party_swings)
-
-    C_geojsons = {"type": "FeatureCollection", 
-              "features": [],
-              "class": 1}
-    Lab_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-    SNP_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-    LD_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-    Green_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-    PC_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-    New_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-    other_geojsons = {"type": "FeatureCollection", 
-                "features": [],
-                "class": 1}
-
-    for i in range(len(geojson_data['features'])):
-        
-        code = geojson_data['features'][i]['properties']['id']
-        winning_party = adjusted_winners_df.loc[adjusted_winners_df['Code'] == code].iloc[:,8:].idxmax(axis=1).iloc[0]
-        
-        if winning_party == 'C':
-            C_geojsons["features"] += [geojson_data['features'][i]]
-        elif winning_party == 'Lab':
-            Lab_geojsons["features"] += [geojson_data['features'][i]]
-        elif winning_party == 'SNP':
-            SNP_geojsons["features"] += [geojson_data['features'][i]]
-        elif winning_party == 'LD':
-            LD_geojsons["features"] += [geojson_data['features'][i]]
-        elif winning_party == 'Green':
-            Green_geojsons["features"] += [geojson_data['features'][i]]
-        elif winning_party == 'PC':
-            PC_geojsons["features"] += [geojson_data['features'][i]]
-        elif winning_party == 'New':
-            New_geojsons["features"] += [geojson_data['features'][i]]
-        else:
-            other_geojsons["features"] += [geojson_data['features'][i]]
+    engine = SwingEngine(ge_df)
+
+    return make_winners_json_list(engine.codes, engine.winning_parties(engine.apply(party_swings)))
+
+
+FeatureJoin = namedtuple('FeatureJoin', ['rows', 'unmatched_features', 'unmatched_codes'])
+
+
+def boundary_ids():
+    return load_geometry().ids.tolist()
+
+
+def join_features(codes, feature_ids=None):
+    """Each boundary feature's row in the results, worked out once.
+
+    rows holds the row of codes for every feature, or -1 where there is none.
+    Feature ids with no results and codes with no feature are kept too, and
+    reported by report_unmatched.
+    """
+    if feature_ids is None:
+        feature_ids = boundary_ids()
+    feature_ids = np.asarray(feature_ids, dtype=object)
+    codes = np.asarray(codes, dtype=object)
+
+    rows = pd.Index(codes).get_indexer(feature_ids)
+    matched = np.zeros(len(codes), dtype=bool)
+    matched[rows[rows >= 0]] = True
+
+    return FeatureJoin(rows, feature_ids[rows < 0], codes[~matched])
+
 
+def report_unmatched(join, name='results'):
+    # warned once at startup, rather than failing inside a callback
+    if len(join.unmatched_features):
+        warnings.warn("{}: no results for {} boundaries, left blank: {}".format(
+            name, len(join.unmatched_features), ', '.join(join.unmatched_features)
+        ))
+    if len(join.unmatched_codes):
+        warnings.warn("{}: no boundary for {} constituencies, not mapped: {}".format(
+            name, len(join.unmatched_codes), ', '.join(join.unmatched_codes)
+        ))
+
+
+def make_winners_json_list(codes, winners, join=None):
+
+    # features are looked up by their precomputed row; without one the join
+    # is worked out (and any mismatch reported) here
+    if join is None:
+        join = join_features(codes)
+        report_unmatched(join)
+    geometry = load_geometry()
+
+    layers = np.full(len(join.rows), -1)
+    matched = join.rows >= 0
+    layers[matched] = map_layer_index(np.asarray(winners)[join.rows[matched]])
+
+    # the decoded features are kept by the store, so this only regroups them
+    features = geometry.features()
     winners_geojson_list = [
-        C_geojsons,
-        Lab_geojsons,
-        SNP_geojsons,
-        LD_geojsons,
-        Green_geojsons,
-        PC_geojsons,
-        New_geojsons,
-        other_geojsons
+        {"type": "FeatureCollection", "features": [], "class": 1}
+        for _ in range(len(map_layer_parties) + 1)
     ]
+    for feature, layer in zip(features, layers.tolist()):
+        if layer >= 0:
+            winners_geojson_list[layer]["features"].append(feature)
 
     return winners_geojson_list
 
+
+def map_layer_index(winners):
+    # the layer each winner is drawn in, as used by make_winners_json_list
+    other = len(map_layer_parties)
+    return np.array([map_layer_parties.get(p, other) for p in winners])
+
+
+bundle_path = './data/election_bundle.npz'
+# bumped whenever the bundle's layout changes
+bundle_version = 6
+
+
+def build_bundle(path=bundle_path, paths=None, boundaries=boundaries_path):
+    """Compile every year's results and the boundaries into one .npz bundle.
+
+    For each year the bundle holds the cleaned results, the vote matrix and
+    its party index, and the join to the boundaries: each feature's row in
+    the results (-1 where there is none) and the codes with no feature.
+    It also holds the feature ids and bounding boxes, the GeoJSON (and a
+    gzip copy) for each level of detail, the stamps of every source file
+    and a hash of the content. Nothing is compressed inside the archive,
+    so every array can be memory-mapped.
+    """
+    catalogue = results_catalogue(paths)
+    sources = sorted(set(catalogue.values())) + [boundaries]
+    geometry = GeometryStore(flatten_topology(load_topology(source=boundaries)))
+    feature_ids = geometry.ids
+
+    arrays = {
+        'years': np.array(list(catalogue)),
+        'feature_ids': feature_ids,
+        'feature_bboxes': geometry.bboxes(),
+        'detail_level_zooms': np.array([min_zoom for min_zoom, _ in detail_levels]),
+    }
+    for year, results in catalogue.items():
+        ge_df = load_results(results, year)
+        engine = SwingEngine(ge_df)
+        prefix = 'results/{}/'.format(year)
+        arrays.update(_frame_arrays(ge_df, prefix))
+        arrays[prefix + 'parties'] = np.array(engine.parties, dtype=str)
+        arrays[prefix + 'votes'] = engine.votes
+        join = join_features(engine.codes, feature_ids)
+        arrays[prefix + 'feature_rows'] = join.rows
+        arrays[prefix + 'unmatched_codes'] = np.array(join.unmatched_codes, dtype=str)
+    for level, data in enumerate(detail_level_geojson(boundaries)):
+        arrays['geometry/{}'.format(level)] = np.frombuffer(data, dtype=np.uint8)
+        # compressed here so the server doesn't have to at startup; with no
+        # timestamp in the header, so identical sources give identical bytes
+        compressed = gzip.compress(data, 9, mtime=0)
+        arrays['geometry/{}.gz'.format(level)] = np.frombuffer(compressed, dtype=np.uint8)
+
+    content = hashlib.sha1()
+    for key in sorted(arrays):
+        content.update(key.encode())
+        content.update(np.ascontiguousarray(arrays[key]).tobytes())
+    arrays['content_hash'] = np.array(content.hexdigest())
+
+    arrays['version'] = np.int64(bundle_version)
+    # the bundle's frames are only as current as the caches they came from
+    arrays['results_version'] = np.int64(results_cache_version)
+    arrays['sources'] = np.array(sources, dtype=str)
+    arrays['source_mtimes'] = np.array([os.stat(p).st_mtime_ns for p in sources])
+    arrays['source_sha1s'] = np.array([file_sha1(p) for p in sources], dtype=str)
+
+    _write_cache(path, arrays)
+    return path
+
+
+class StaleBundleError(Exception):
+    pass
+
+
+def load_bundle(path=bundle_path):
+    """Open a bundle made by build_bundle, refusing one that is out of date.
+
+    Raises StaleBundleError if the bundle is missing, from another version
+    of this module or older than any of its source files.
+    """
+    rebuild = "; rebuild it with: python -m df_wrangling build"
+    if not os.path.exists(path):
+        raise StaleBundleError(
+            "{} does not exist; build it with: python -m df_wrangling build".format(path)
+        )
+
+    arrays = MappedArchive(path)
+    if (
+        arrays['version'] != bundle_version
+        or arrays['results_version'] != results_cache_version
+    ):
+        raise StaleBundleError("{} is from another version{}".format(path, rebuild))
+    for source, mtime, sha1 in zip(
+        arrays['sources'], arrays['source_mtimes'], arrays['source_sha1s']
+    ):
+        if not os.path.exists(source):
+            raise StaleBundleError("{} is missing{}".format(source, rebuild))
+        if os.stat(source).st_mtime_ns != mtime and file_sha1(source) != sha1:
+            raise StaleBundleError("{} has changed{}".format(source, rebuild))
+
+    return Bundle(arrays)
+
+
+# the .npy header layouts MappedArchive can read; np.save only writes 3.0
+# for field names that aren't latin-1, which the bundle never has
+npy_header_readers = {
+    (1, 0): np.lib.format.read_array_header_1_0,
+    (2, 0): np.lib.format.read_array_header_2_0,
+}
+
+
+class MappedArchive:
+    """The arrays of an uncompressed .npz, each memory-mapped read-only.
+
+    Arrays are mapped straight out of the archive on first use, so every
+    process that opens the same file shares one copy in the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+        with zipfile.ZipFile(path) as archive:
+            self.offsets = {}
+            for info in archive.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError("{} is compressed and can't be mapped".format(path))
+                self.offsets[info.filename[:-len('.npy')]] = info.header_offset
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __getitem__(self, key):
+        if key not in self.arrays:
+            self.arrays[key] = self._map(key)
+        return self.arrays[key]
+
+    def _map(self, key):
+        with open(self.path, 'rb') as f:
+            # skip the zip entry's local header to reach the .npy file
+            f.seek(self.offsets[key])
+            name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            version = np.lib.format.read_magic(f)
+            if version not in npy_header_readers:
+                raise ValueError("{} in {} is a version {}.{} .npy, which can't be mapped".format(
+                    key, self.path, *version
+                ))
+            shape, fortran_order, dtype = npy_header_readers[version](f)
+            offset = f.tell()
+
+            if not shape or 0 in shape:
+                # scalars and empty arrays aren't worth a mapping
+                count = int(np.prod(shape))
+                return np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+        return np.memmap(
+            self.path,
+            dtype=dtype,
+            mode='r',
+            shape=shape,
+            offset=offset,
+            order='F' if fortran_order else 'C',
+        )
+
+
+class Bundle:
+    """Read access to a compiled bundle, memory-mapped a piece at a time."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.content_hash = str(arrays['content_hash'])
+        self.years = arrays['years'].tolist()
+        self.feature_ids = arrays['feature_ids'].astype(object)
+        self.feature_bboxes = arrays['feature_bboxes']
+        self.detail_level_zooms = arrays['detail_level_zooms'].tolist()
+
+    def results(self, year):
+        return _frame_from_cache(self.arrays, 'results/{}/'.format(year))
+
+    def engine(self, year):
+        prefix = 'results/{}/'.format(year)
+        return SwingEngine.from_matrix(
+            self.arrays[prefix + 'parties'].tolist(),
+            self.arrays[prefix + 'col_{}'.format(self._code_column(prefix))].astype(object),
+            self.arrays[prefix + 'votes'],
+        )
+
+    def _code_column(self, prefix):
+        return self.arrays[prefix + 'columns'].tolist().index('Code')
+
+    def feature_join(self, year):
+        rows = self.arrays['results/{}/feature_rows'.format(year)]
+        return FeatureJoin(
+            rows,
+            self.feature_ids[rows < 0],
+            self.arrays['results/{}/unmatched_codes'.format(year)].astype(object),
+        )
+
+    def geometry(self, level):
+        # GeoJSON bytes, as a read-only buffer over the mapped file
+        return self.arrays['geometry/{}'.format(level)]
+
+    def compressed_geometry(self, level):
+        return self.arrays['geometry/{}.gz'.format(level)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m df_wrangling')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='compile the results and boundaries into a bundle')
+    build.add_argument('--output', default=bundle_path)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        print(build_bundle(args.output))
@@ -0,0 +1,518 @@
+import json
+import os
+import gzip
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+
+boundaries_path = './data/parliamentary_boundaries.json'
+topology_path = './data/parliamentary_boundaries.topo.json'
+
+# integer grid the topology coordinates are snapped to along the longer axis
+quantization = 10 ** 6
+
+# one year; the URL changes whenever the content does
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+# (lowest map zoom, Douglas-Peucker tolerance in degrees) for each level of
+# detail; each tolerance is about a screen pixel at its lowest zoom and 0
+# keeps every vertex
+detail_levels = [(0, 0.02), (6, 0.005), (7.5, 0)]
+
+
+def read_geojson(path=boundaries_path):
+    with open(path) as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def load_boundaries(path=topology_path):
+    """Constituency boundary GeoJSON, decoded once per process on first use."""
+    return load_geometry(path).feature_collection()
+
+
+@lru_cache(maxsize=None)
+def load_geometry(path=topology_path):
+    """The boundaries as a GeometryStore, built once per process on first use.
+
+    Only the flat integer arrays are kept; the topology they come from is
+    dropped once they are built.
+    """
+    return GeometryStore(flatten_topology(load_topology(path)))
+
+
+def topology_path_for(source):
+    return os.path.splitext(source)[0] + '.topo.json'
+
+
+def load_topology(path=None, source=boundaries_path):
+    """The shared-arc topology of the boundaries, with integer arc coordinates.
+
+    Built from the GeoJSON source if the file is missing or out of date; by
+    default the file sits next to the source, as topology_path_for names it.
+    """
+    if path is None:
+        path = topology_path_for(source)
+    if not os.path.exists(path) or os.stat(path).st_mtime < os.stat(source).st_mtime:
+        build_topojson(source, path)
+    return read_topojson(path)
+
+
+# read once at import, while nothing else can be changing it
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+@contextmanager
+def replace_file(path, mode='wb'):
+    """Open a temporary file that replaces ``path`` once it is closed.
+
+    Each writer gets a temporary file of its own, so processes writing the
+    same file at once never write into each other's and readers only ever
+    see a complete file; the last writer to finish wins.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.',
+        suffix='.tmp',
+    )
+    try:
+        # mkstemp makes the file private; give it what open() would have
+        os.chmod(tmp_path, 0o666 & ~_umask)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def serve_geometry(server, name, data, compressed=None, version=None):
+    """Serve GeoJSON from the Flask ``server`` at a content-versioned URL.
+
+    ``data`` (and ``compressed``) may be bytes or any buffer over them, such
+    as an array memory-mapped from the bundle; they're only copied per request.
+
+    The response carries a content-hash ETag and immutable cache headers, and
+    a gzip copy (compressed once up front unless given) is sent to clients
+    that accept it. ``version`` is the hash to use when one is already known,
+    such as a bundle's; otherwise data is hashed here. Returns the URL path
+    to reference from the map.
+    """
+    from flask import abort, request, Response
+
+    if version is None:
+        version = hashlib.sha1(data).hexdigest()
+    version = version[:16]
+    if compressed is None:
+        compressed = gzip.compress(data, 9, mtime=0)
+    files = server.config.setdefault('GEOMETRY_FILES', {})
+    files[name] = (version, data, compressed)
+
+    if 'geometry_file' not in server.view_functions:
+
+        @server.route('/geometry/<name>.<version>.json')
+        def geometry_file(name, version):
+            if files.get(name, (None,))[0] != version:
+                abort(404)
+            _, raw, compressed = files[name]
+
+            use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+            etag = version + ('-gz' if use_gzip else '')
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                # WSGI bodies must be bytes, so copy out of the buffer here
+                response = Response(
+                    bytes(compressed if use_gzip else raw),
+                    mimetype='application/json',
+                )
+                if use_gzip:
+                    response.headers['Content-Encoding'] = 'gzip'
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = immutable_cache_control
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+    return '/geometry/{}.{}.json'.format(name, version)
+
+
+def feature_rings(feature):
+    # polygons of a Polygon/MultiPolygon feature as lists of rings
+    geometry = feature['geometry']
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def flatten_topology(topology):
+    """Every feature's rings as flat arrays, for GeometryStore.
+
+    coordinates is one int32 (x, y) array on the topology's own integer
+    grid, each ring being its arcs joined end to end, so nothing is decoded
+    to degrees on the way. ring_offsets, polygon_offsets and
+    feature_offsets each give where every ring, polygon and feature starts
+    in the level below, with a final end offset. transform holds the grid's
+    scale and translate.
+    """
+    arcs = topology['arcs']
+    rings, ring_counts, polygon_counts = [], [], []
+    for obj in topology['objects']:
+        polygon_counts.append(len(obj['arcs']))
+        for polygon in obj['arcs']:
+            ring_counts.append(len(polygon))
+            for ring in polygon:
+                ring_arcs = [arcs[i] if i >= 0 else arcs[~i][::-1] for i in ring]
+                # each arc starts where the one before it ends
+                rings.append(np.concatenate(ring_arcs[:1] + [arc[1:] for arc in ring_arcs[1:]]))
+
+    def offsets(counts):
+        return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    transform = topology['transform']
+    return {
+        'ids': np.array([obj['properties']['id'] for obj in topology['objects']], dtype=str),
+        'names': np.array([obj['properties']['name'] for obj in topology['objects']], dtype=str),
+        'coordinates': np.concatenate(rings).astype(np.int32),
+        'ring_offsets': offsets([len(ring) for ring in rings]),
+        'polygon_offsets': offsets(ring_counts),
+        'feature_offsets': offsets(polygon_counts),
+        'transform': np.array([transform['scale'], transform['translate']], dtype=float),
+    }
+
+
+class GeometryStore:
+    """Boundary coordinates held in flat integer arrays.
+
+    Takes the arrays from flatten_topology. Slicing a feature's rings gives
+    views of the shared coordinate array, so nothing is copied until the
+    coordinates are turned back into degrees. GeoJSON for the features is
+    only decoded when asked for, then kept for the life of the store.
+    """
+
+    def __init__(self, arrays):
+        self.ids = arrays['ids']
+        self.names = arrays['names']
+        self.coordinates = arrays['coordinates']
+        self.ring_offsets = arrays['ring_offsets']
+        self.polygon_offsets = arrays['polygon_offsets']
+        self.feature_offsets = arrays['feature_offsets']
+        self.scale, self.translate = np.asarray(arrays['transform'])
+        # degrees are rounded to the grid's precision, as topology_to_geojson does
+        self.digits = int(np.ceil(-np.log10(self.scale.min())))
+        self._features = None
+
+    def __len__(self):
+        return len(self.feature_offsets) - 1
+
+    def rings(self, feature):
+        # [polygon][ring] views of the quantized coordinates
+        polygons = []
+        for p in range(self.feature_offsets[feature], self.feature_offsets[feature + 1]):
+            first, last = self.polygon_offsets[p], self.polygon_offsets[p + 1]
+            polygons.append([
+                self.coordinates[self.ring_offsets[r]:self.ring_offsets[r + 1]]
+                for r in range(first, last)
+            ])
+        return polygons
+
+    def to_degrees(self, points):
+        return np.round(points * self.scale + self.translate, self.digits)
+
+    def feature(self, feature):
+        # one GeoJSON feature, in degrees
+        polygons = [
+            [self.to_degrees(ring).tolist() for ring in polygon]
+            for polygon in self.rings(feature)
+        ]
+        if len(polygons) == 1:
+            geometry = {'type': 'Polygon', 'coordinates': polygons[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+        return {
+            'type': 'Feature',
+            'properties': {'id': str(self.ids[feature]), 'name': str(self.names[feature])},
+            'geometry': geometry,
+        }
+
+    def features(self):
+        # every feature as GeoJSON, decoded on the first call and kept; a
+        # process that never draws a map from Python never pays for them
+        if self._features is None:
+            self._features = [self.feature(i) for i in range(len(self))]
+        return self._features
+
+    def feature_collection(self, features=None):
+        # GeoJSON for the given features, or all of them, sharing the kept dicts
+        decoded = self.features()
+        if features is None:
+            features = range(len(self))
+        return {
+            'type': 'FeatureCollection',
+            'features': [decoded[i] for i in features],
+        }
+
+    def bboxes(self):
+        # (min lon, min lat, max lon, max lat) of every feature
+        starts = self.ring_offsets[self.polygon_offsets[self.feature_offsets[:-1]]]
+        lower = np.minimum.reduceat(self.coordinates, starts)
+        upper = np.maximum.reduceat(self.coordinates, starts)
+        return np.hstack([self.to_degrees(lower), self.to_degrees(upper)])
+
+
+def build_topology(geojson):
+    """Split every ring into arcs between junctions, storing shared borders once.
+
+    A junction is a vertex whose neighbours differ between the rings that use
+    it. Each feature's rings become lists of arc indices; ``~i`` refers to
+    arc ``i`` reversed, as in TopoJSON.
+    """
+    rings = []
+    for feature in geojson['features']:
+        for polygon in feature_rings(feature):
+            rings += [[tuple(point) for point in ring[:-1]] for ring in polygon]
+
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = (ring[i - 1], ring[(i + 1) % n])
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair and seen != pair[::-1]:
+                junctions.add(point)
+
+    arcs = []
+    arc_index = {}
+
+    def add_arc(points):
+        key = tuple(points)
+        if key in arc_index:
+            return arc_index[key]
+        if key[::-1] in arc_index:
+            return ~arc_index[key[::-1]]
+        arc_index[key] = len(arcs)
+        arcs.append(points)
+        return len(arcs) - 1
+
+    ring_arcs = []
+    for ring in rings:
+        cuts = [i for i, point in enumerate(ring) if point in junctions]
+        if not cuts:
+            # a ring touching no other ring is one closed arc; start it at its
+            # smallest vertex so an identical ring elsewhere matches
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            ring_arcs.append([add_arc(ring + [ring[0]])])
+            continue
+        ring = ring[cuts[0]:] + ring[:cuts[0]]
+        cuts = [i - cuts[0] for i in cuts] + [len(ring)]
+        ring = ring + [ring[0]]
+        ring_arcs.append([add_arc(ring[a:b + 1]) for a, b in zip(cuts, cuts[1:])])
+
+    objects = []
+    rings_used = iter(ring_arcs)
+    for feature in geojson['features']:
+        polygons = [[next(rings_used) for _ in polygon] for polygon in feature_rings(feature)]
+        objects.append({'properties': feature['properties'], 'arcs': polygons})
+
+    return {'arcs': [np.array(arc) for arc in arcs], 'objects': objects}
+
+
+def quantize_topology(topology, quantization=quantization):
+    """Snap arc coordinates to an integer grid, recording the transform back."""
+    points = np.concatenate(topology['arcs'])
+    translate = points.min(axis=0)
+    step = (points.max(axis=0) - translate).max() / (quantization - 1)
+
+    arcs = []
+    for arc in topology['arcs']:
+        arc = np.round((arc - translate) / step).astype(np.int32)
+        # drop vertices that land on the one before, keeping the arc's ends
+        keep = np.ones(len(arc), dtype=bool)
+        keep[1:-1] = (np.diff(arc[:-1], axis=0) != 0).any(axis=1)
+        arcs.append(arc[keep])
+
+    return {
+        'transform': {'scale': [step, step], 'translate': translate.tolist()},
+        'arcs': arcs,
+        'objects': topology['objects'],
+    }
+
+
+def write_topojson(topology, path=topology_path):
+    # TopoJSON layout: delta-encoded arcs and one geometry per constituency
+    geometries = []
+    for obj in topology['objects']:
+        polygons = obj['arcs']
+        if len(polygons) == 1:
+            geometries.append({'type': 'Polygon', 'arcs': polygons[0]})
+        else:
+            geometries.append({'type': 'MultiPolygon', 'arcs': polygons})
+        geometries[-1]['properties'] = obj['properties']
+
+    topojson = {
+        'type': 'Topology',
+        'transform': topology['transform'],
+        'objects': {
+            'constituencies': {'type': 'GeometryCollection', 'geometries': geometries},
+        },
+        'arcs': [np.vstack([arc[:1], np.diff(arc, axis=0)]).tolist() for arc in topology['arcs']],
+    }
+    with replace_file(path, 'w') as f:
+        json.dump(topojson, f, separators=(',', ':'))
+
+
+def read_topojson(path=topology_path):
+    with open(path) as f:
+        topojson = json.load(f)
+
+    objects = []
+    for geometry in topojson['objects']['constituencies']['geometries']:
+        polygons = geometry['arcs']
+        if geometry['type'] == 'Polygon':
+            polygons = [polygons]
+        objects.append({'properties': geometry['properties'], 'arcs': polygons})
+
+    return {
+        'transform': topojson['transform'],
+        'arcs': [np.cumsum(np.array(arc, dtype=np.int32), axis=0, dtype=np.int32) for arc in topojson['arcs']],
+        'objects': objects,
+    }
+
+
+def build_topojson(source=boundaries_path, path=None):
+    if path is None:
+        path = topology_path_for(source)
+    write_topojson(quantize_topology(build_topology(read_geojson(source))), path)
+
+
+def simplify_line(points, tolerance):
+    """Douglas-Peucker simplification of an open line, keeping both ends."""
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    if (points[0] == points[-1]).all():
+        # closed line: split at the vertex farthest from the start
+        far = np.hypot(*(points - points[0]).T).argmax()
+        return np.concatenate([
+            simplify_line(points[:far + 1], tolerance)[:-1],
+            simplify_line(points[far:], tolerance),
+        ])
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        inner = points[first + 1:last]
+        dx, dy = end - start
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(*(inner - start).T)
+        else:
+            distances = np.abs(dx * (inner[:, 1] - start[1]) - dy * (inner[:, 0] - start[0])) / length
+        i = distances.argmax()
+        if distances[i] > tolerance:
+            keep[first + 1 + i] = True
+            stack += [(first, first + 1 + i), (first + 1 + i, last)]
+
+    return points[keep]
+
+
+def topology_to_geojson(topology, arcs=None):
+    """Rebuild GeoJSON from a topology, optionally with replacement arcs.
+
+    Rings that replacement arcs collapse below a triangle fall back to the
+    topology's own arcs so no constituency disappears.
+    """
+    full_arcs = topology['arcs']
+    if arcs is None:
+        arcs = full_arcs
+
+    transform = topology.get('transform')
+    if transform:
+        # back from the integer grid, rounded to the grid's precision
+        scale = np.array(transform['scale'])
+        translate = np.array(transform['translate'])
+        digits = int(np.ceil(-np.log10(scale.min())))
+        arcs = [np.round(arc * scale + translate, digits) for arc in arcs]
+        full_arcs = [np.round(arc * scale + translate, digits) for arc in full_arcs]
+
+    def ring_coordinates(ring, arcs):
+        points = []
+        for i in ring:
+            arc = arcs[i] if i >= 0 else arcs[~i][::-1]
+            points += arc[1:].tolist() if points else arc.tolist()
+        return points
+
+    features = []
+    for obj in topology['objects']:
+        polygons = []
+        for polygon in obj['arcs']:
+            rings = []
+            for ring in polygon:
+                coordinates = ring_coordinates(ring, arcs)
+                if len(coordinates) < 4:
+                    coordinates = ring_coordinates(ring, full_arcs)
+                rings.append(coordinates)
+            polygons.append(rings)
+
+        if len(polygons) == 1:
+            geometry = {'type': 'Polygon', 'coordinates': polygons[0]}
+        else:
+            geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+        features.append({'type': 'Feature', 'properties': obj['properties'], 'geometry': geometry})
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def detail_level_path(path, level):
+    return '{}.lod{}.json'.format(os.path.splitext(path)[0], level)
+
+
+def detail_level_geojson(path=boundaries_path):
+    """Compact GeoJSON bytes of the boundaries for each level of detail.
+
+    The shared arcs of the topology are simplified rather than rings, so
+    neighbouring constituencies keep an identical border at every level.
+    """
+    topology = load_topology(source=path)
+    step = topology['transform']['scale'][0]
+
+    levels = []
+    for _, tolerance in detail_levels:
+        arcs = [simplify_line(arc, tolerance / step) for arc in topology['arcs']]
+        geojson = topology_to_geojson(topology, arcs)
+        levels.append(json.dumps(geojson, separators=(',', ':')).encode())
+
+    return levels
+
+
+def build_detail_levels(path=boundaries_path):
+    """Write a GeoJSON copy of the boundaries for each level of detail."""
+    paths = []
+    for level, data in enumerate(detail_level_geojson(path)):
+        paths.append(detail_level_path(path, level))
+        with replace_file(paths[-1]) as f:
+            f.write(data)
+
+    return paths
+
+
+def detail_level_for_zoom(zoom):
+    return max(level for level, (min_zoom, _) in enumerate(detail_levels) if zoom >= min_zoom)
+
+
+if __name__ == '__main__':
+    build_topojson()
+    print(topology_path)
+    for level_path in build_detail_levels():
+        print(level_path)
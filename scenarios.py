@@ -0,0 +1,515 @@
+import multiprocessing
+import sys
+import threading
+import types
+
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from df_wrangling import count_seats, party_renaming_dict
+
+MonteCarloResult = namedtuple(
+    'MonteCarloResult',
+    ['outcomes', 'seats', 'majority_probability', 'win_probability'],
+)
+
+
+def majority_seats(engine):
+    return len(engine.votes) // 2 + 1
+
+
+def sample_swings(distributions, n, rng):
+    """Draw n percentage swings for each party in distributions.
+
+    Each party maps to a fixed swing, or to one of ('uniform', low, high),
+    ('normal', mean, sd) or ('triangular', low, mode, high). Draws are
+    clipped to 0-100. Returns an (n x parties) array in distributions order.
+    """
+    swings = np.empty((n, len(distributions)))
+    for i, spec in enumerate(distributions.values()):
+        if np.isscalar(spec):
+            swings[:, i] = spec
+        elif spec[0] == 'uniform':
+            swings[:, i] = rng.uniform(spec[1], spec[2], n)
+        elif spec[0] == 'normal':
+            swings[:, i] = rng.normal(spec[1], spec[2], n)
+        elif spec[0] == 'triangular':
+            swings[:, i] = rng.triangular(spec[1], spec[2], spec[3], n)
+        else:
+            raise ValueError("unknown swing distribution: {!r}".format(spec[0]))
+    return np.clip(swings, 0, 100)
+
+
+# processes in the pool simulations share unless monte_carlo is told otherwise;
+# every process running simulations (each server worker, say) has its own pool
+pool_workers = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def simulation_pool(workers=None):
+    """The process pool monte_carlo runs on, started on first use and reused.
+
+    It is started with ``workers`` processes (pool_workers by default); later
+    calls get the same pool whatever they ask for. The processes are
+    spawned rather than forked, so none inherits a threaded server's state;
+    submit work with _submit, so that none re-runs the server's script.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                workers or pool_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+@contextmanager
+def _bare_main():
+    # a spawned process runs the parent's __main__ again before its first
+    # task, which for an app script means loading and building the whole
+    # app; a process spawned while a bare module stands in for it only
+    # imports what its tasks need. Callers hold _pool_lock, so only one
+    # swap is ever in progress
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def _submit(pool, fn, *iterables):
+    # the pool spawns its processes as work is submitted, so they all start
+    # here; the results are collected once the lock is released
+    with _pool_lock, _bare_main():
+        return [pool.submit(fn, *args) for args in zip(*iterables)]
+
+
+def _discard_pool(pool):
+    # a pool that lost a process can't be used again; the next call starts another
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def _simulate(distributions, n, seed, engine):
+    n_seats, n_outcomes = len(engine.votes), len(engine.outcomes)
+    swings = sample_swings(distributions, n, np.random.default_rng(seed))
+
+    seats = np.empty((n, n_outcomes), dtype=int)
+    wins = np.zeros(n_seats * n_outcomes, dtype=int)
+    seat_offsets = np.arange(n_seats) * n_outcomes
+    for start, winners in engine.winners_batch(swings, list(distributions)):
+        seats[start:start + len(winners)] = count_seats(winners, n_outcomes)
+        wins += np.bincount((winners + seat_offsets).ravel(), minlength=len(wins))
+
+    return seats, wins.reshape(n_seats, n_outcomes)
+
+
+def monte_carlo(engine, distributions, n_simulations=100000, seed=None, workers=None, chunk_size=10000):
+    """Seat projection from randomly sampled swings to the new party.
+
+    distributions is as for sample_swings. Simulations run in chunks of
+    chunk_size on the shared simulation_pool (started with ``workers``
+    processes if it isn't running yet), or in this process if workers=1.
+    Each chunk has its own seed spawned from ``seed``. Results are
+    reproducible for a given seed and chunk_size.
+    """
+    if n_simulations < 1:
+        raise ValueError("n_simulations must be at least 1, not {}".format(n_simulations))
+
+    sizes = [chunk_size] * (n_simulations // chunk_size)
+    if n_simulations % chunk_size:
+        sizes.append(n_simulations % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    if workers == 1:
+        chunks = [_simulate(distributions, n, s, engine) for n, s in zip(sizes, seeds)]
+    else:
+        # the engine goes with each chunk; pickling it is far cheaper than a chunk
+        pool = simulation_pool(workers)
+        try:
+            futures = _submit(
+                pool, _simulate, [distributions] * len(sizes), sizes, seeds, [engine] * len(sizes)
+            )
+            chunks = [future.result() for future in futures]
+        except BrokenProcessPool:
+            _discard_pool(pool)
+            raise
+
+    seats = np.concatenate([seats for seats, _ in chunks])
+    wins = sum(wins for _, wins in chunks)
+
+    return MonteCarloResult(
+        outcomes=engine.outcomes,
+        seats=seats,
+        majority_probability=(seats >= majority_seats(engine)).mean(axis=0),
+        win_probability=wins / n_simulations,
+    )
+
+
+def seat_projection_table(result):
+    # one row per party that won a seat in any simulation
+    won = result.seats.max(axis=0) > 0
+    seats = result.seats[:, won]
+
+    projection_df = pd.DataFrame({
+        'party': result.outcomes[won],
+        'mean_seats': seats.mean(axis=0),
+        'low_seats': np.percentile(seats, 5, axis=0),
+        'high_seats': np.percentile(seats, 95, axis=0),
+        'majority_probability': result.majority_probability[won],
+    })
+    projection_df = projection_df.sort_values('mean_seats', ascending=False, ignore_index=True)
+    projection_df = projection_df.replace({'party': party_renaming_dict})
+
+    return projection_df
+
+
+def _changes_passed(swings, inclusive, s):
+    # changes sorted by swing, those at a swing before those just after it
+    first, last = np.searchsorted(swings, s, 'left'), np.searchsorted(swings, s, 'right')
+    return first + inclusive[first:last].sum()
+
+
+class FlipIndex:
+    """Sorted seat-flip thresholds for swings from a single party.
+
+    With one party swinging, a constituency's winner can only be that party,
+    the new party or its best other party. So the winner changes at no more
+    than three swings, where two of those lines cross. These are found once
+    per party, with the winner either side worked out by the same arithmetic
+    as SwingEngine.apply. Seat counts and flipped seats for any swing are then
+    binary searches over the sorted thresholds. A party the engine doesn't
+    have stood nowhere, so swinging it changes no seat.
+    """
+
+    def __init__(self, engine, parties=None):
+        self.engine = engine
+        self.parties = [
+            p for p in (engine.parties if parties is None else parties) if p in engine.party_index
+        ]
+        self.base_winners = engine.apply({}).winners
+        self.base_seats = np.bincount(self.base_winners, minlength=len(engine.outcomes))
+        self._events = {}
+        self._first_flips = {}
+        for party in self.parties:
+            self._index_party(party)
+
+    def _winners_at(self, party, swing, rows=slice(None)):
+        # winners with only ``party`` swinging, swing being fractions per row
+        p = self.engine.party_index[party]
+        votes = self.engine.votes[rows]
+        swing = np.asarray(swing, dtype=float)
+        new_votes = np.empty(swing.shape + (len(self.engine.outcomes),))
+        new_votes[..., :-1] = votes
+        new_votes[..., p] = votes[..., p] * (1 - swing)
+        new_votes[..., -1] = votes[..., p] * swing
+        return new_votes.argmax(axis=-1)
+
+    def _index_party(self, party):
+        p = self.engine.party_index[party]
+        n_outcomes = len(self.engine.outcomes)
+        votes = self.engine.votes
+        best_other = np.delete(votes, p, axis=1).max(axis=1)
+
+        # where the party's remaining vote, the new party's vote and the best
+        # other party's vote cross
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossings = np.column_stack([
+                1 - best_other / votes[:, p],
+                best_other / votes[:, p],
+                np.full(len(votes), 0.5),
+            ])
+        crossings = np.sort(np.clip(np.nan_to_num(crossings, nan=1.0), 0, 1), axis=1)
+
+        # swings 0, then each crossing with the midpoints around it, then 1
+        edges = np.column_stack([np.zeros(len(votes)), crossings, np.ones(len(votes))])
+        points = np.empty((len(votes), 2 * edges.shape[1] - 1))
+        points[:, ::2] = edges
+        points[:, 1::2] = (edges[:, :-1] + edges[:, 1:]) / 2
+        winners = self._winners_at(party, points.T).T
+
+        # a change into an edge happens at that swing, a change out of an edge
+        # happens just after it
+        at_edge = points[:, 1:] != points[:, :-1]
+        into_edge = np.zeros(at_edge.shape, dtype=bool)
+        into_edge[:, 1::2] = True
+        changed = (winners[:, 1:] != winners[:, :-1]) & at_edge
+        rows, steps = np.nonzero(changed)
+        swings = np.where(into_edge[rows, steps], points[rows, steps + 1], points[rows, steps])
+        inclusive = into_edge[rows, steps]
+        gained, lost = winners[rows, steps + 1], winners[rows, steps]
+
+        # seat totals after each change, in the order the changes happen
+        order = np.lexsort((~inclusive, swings))
+        deltas = np.zeros((len(order) + 1, n_outcomes), dtype=int)
+        deltas[np.arange(1, len(order) + 1), gained[order]] += 1
+        deltas[np.arange(1, len(order) + 1), lost[order]] -= 1
+        deltas[0] = self.base_seats
+        self._events[party] = (swings[order], inclusive[order], deltas.cumsum(axis=0))
+
+        # the winner never returns to the one at no swing, so a seat has
+        # flipped exactly when its first change is passed
+        first = np.unique(rows, return_index=True)[1]
+        order = np.lexsort((~inclusive[first], swings[first]))
+        self._first_flips[party] = (
+            rows[first][order],
+            swings[first][order],
+            inclusive[first][order],
+            gained[first][order],
+        )
+
+    def seats(self, party, swing):
+        """Seats per outcome (as engine.outcomes) for a percentage swing."""
+        if party not in self._events:
+            return self.base_seats
+        swings, inclusive, seats = self._events[party]
+        return seats[_changes_passed(swings, inclusive, swing / 100)]
+
+    def flips(self, party, swing):
+        """Constituencies that change hands at a percentage swing, in swing order."""
+        if party not in self._first_flips:
+            return self._no_flips(party)
+        rows, swings, inclusive, _ = self._first_flips[party]
+        s = swing / 100
+        n = _changes_passed(swings, inclusive, s)
+        winners = self._winners_at(party, np.full(n, s), rows[:n])
+        return self._flip_table(party, rows[:n], swings[:n], winners)
+
+    def marginal_seats(self, party, n=10):
+        """The n constituencies that change hands at the smallest swing."""
+        if party not in self._first_flips:
+            return self._no_flips(party)
+        rows, swings, _, gained = self._first_flips[party]
+        return self._flip_table(party, rows[:n], swings[:n], gained[:n])
+
+    def _no_flips(self, party):
+        none = np.array([], dtype=int)
+        return self._flip_table(party, none, none.astype(float), none)
+
+    def _flip_table(self, party, rows, swings, winners):
+        ge_outcomes = self.engine.outcomes
+        flips_df = pd.DataFrame({
+            'Code': self.engine.codes[rows],
+            'swing': swings * 100,
+            'from': ge_outcomes[self.base_winners[rows]],
+            'to': ge_outcomes[winners],
+        })
+        return flips_df.replace({'from': party_renaming_dict, 'to': party_renaming_dict})
+
+
+SeatTarget = namedtuple('SeatTarget', ['party', 'seats', 'at_least'])
+SeatTarget.__doc__ = """A seat count to reach: ``party`` with at least ``seats`` seats,
+or fewer than ``seats`` when ``at_least`` is False."""
+
+
+def majority_target(engine, party='New'):
+    return SeatTarget(party, majority_seats(engine), True)
+
+
+def lose_majority_target(engine, party='C'):
+    return SeatTarget(party, majority_seats(engine), False)
+
+
+def target_met(engine, target, seats):
+    # for each row of a (scenarios x outcomes) seat array
+    party_seats = seats[..., list(engine.outcomes).index(target.party)]
+    if target.at_least:
+        return party_seats >= target.seats
+    return party_seats < target.seats
+
+
+def minimal_swing(engine, target, parties, tolerance=0.01, max_scenarios=200, refine=4):
+    """Smallest swing from ``parties`` to the new party that meets ``target``.
+
+    One party: a 1% grid finds the first swing that meets the target and
+    bisection narrows it to ``tolerance``. Several parties: the answer for
+    each set of one party fewer is found the same way, so allowing another
+    party never makes the answer worse, and competes with the feasible
+    points of a batched grid of up to max_scenarios swing vectors in which
+    every party swings. The one with the smallest total swing is improved
+    by ``refine`` rounds of cutting and moving swing between parties with a
+    halving step, bisection along the line from no swing and lowering each
+    party's swing in turn.
+    Returns {party: swing} or None when even 100% swings miss the target.
+    """
+    best = _minimal_swing(engine, target, tuple(parties), tolerance, max_scenarios, refine, {})
+    if best is None:
+        return None
+    return {p: float(s) for p, s in zip(parties, best)}
+
+
+def _minimal_swing(engine, target, parties, tolerance, max_scenarios, refine, solved):
+    # the swing vector for parties, or None; solved holds the answers for
+    # the smaller sets already worked out in this search
+    if parties in solved:
+        return solved[parties]
+
+    def met(swings):
+        return target_met(engine, target, engine.seats_batch(swings, list(parties)))
+
+    def smallest(candidates):
+        # least total swing, then the most even
+        return candidates[np.lexsort((candidates.max(axis=1), candidates.sum(axis=1)))[0]]
+
+    n = len(parties)
+    if n == 1:
+        grid = np.arange(101.0)[:, None]
+        feasible = met(grid)
+        if not feasible.any():
+            best = None
+        elif feasible.argmax() == 0:
+            best = np.zeros(1)
+        else:
+            i = feasible.argmax()
+            best = np.array([_first_met(met, lambda v: v[:, None], grid[i - 1, 0], grid[i, 0], tolerance)])
+        solved[parties] = best
+        return best
+
+    candidates = []
+    for i in range(n):
+        fewer = _minimal_swing(
+            engine, target, parties[:i] + parties[i + 1:], tolerance, max_scenarios, refine, solved
+        )
+        if fewer is not None:
+            candidates.append(np.insert(fewer, i, 0.0))
+
+    # the grid spacing that keeps the number of scenarios within budget;
+    # points with a party on no swing were covered by the smaller sets
+    n_points = max(1, int(max_scenarios ** (1 / n)))
+    axes = [np.linspace(0, 100, n_points + 1)[1:]] * n
+    grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, n)
+    candidates.extend(grid[met(grid)])
+    if not candidates:
+        solved[parties] = None
+        return None
+    best = smallest(np.array(candidates))
+
+    # moves that lower the total: cut one party's swing, or move a step of
+    # it to another party while cutting some more
+    eye = np.eye(n)
+    moves = np.vstack([-eye] + [
+        eye[j] - cut * eye[i] for cut in (1.1, 1.5, 3) for i in range(n) for j in range(n) if i != j
+    ])
+    step = 100 / n_points / 2
+    for _ in range(refine):
+        while True:
+            tried = np.clip(best + step * moves, 0, 100)
+            feasible = tried[met(tried)]
+            if not len(feasible) or feasible.sum(axis=1).min() >= best.sum():
+                break
+            best = smallest(feasible)
+        step /= 2
+
+    # the same direction, scaled down as far as the target allows
+    if best.max() > 0:
+        best = best * _first_met(met, lambda v: v[:, None] * best, 0.0, 1.0, tolerance / best.max())
+
+    # then lower each party's swing in turn, trying 21 values at once
+    for i in range(n):
+        tried = np.repeat(best[None, :], 21, axis=0)
+        tried[:, i] = np.linspace(0, best[i], 21)
+        best = tried[met(tried).argmax()]
+
+    solved[parties] = best
+    return best
+
+
+def _first_met(met, points, low, high, tolerance, n=16):
+    # the lowest value in (low, high] whose swing vector meets the target,
+    # to within tolerance, given that high does: a bisection that tries n
+    # values per batch instead of one
+    while high - low > tolerance:
+        values = np.linspace(low, high, n + 1)[1:]
+        i = met(points(values)).argmax()
+        low, high = (values[i - 1] if i else low), values[i]
+    return high
+
+
+def sensitivity_grid(engine, party_x, party_y):
+    """Seats won over every pair of whole-number swings from two parties.
+
+    All 101 x 101 scenarios are one batched, chunked evaluation. Returns (swings, seats), where
+    seats[i, j] holds the seats per outcome (as engine.outcomes) with
+    party_x swinging swings[i] and party_y swinging swings[j].
+    """
+    swings = np.arange(101)
+    grid = np.stack(np.meshgrid(swings, swings, indexing='ij'), axis=-1).reshape(-1, 2)
+    seats = engine.seats_batch(grid, [party_x, party_y])
+    seats = seats.reshape(len(swings), len(swings), -1)
+    seats.flags.writeable = False
+    return swings, seats
+
+
+def swing_sweep(engine, party, party_swings=None):
+    """Winners and seats as ``party`` swings from 0 to 100%, in one batched pass.
+
+    Other parties keep their swings from party_swings. Returns (swings,
+    winners, seats), with one row per whole-number swing.
+    """
+    party_swings = dict(party_swings or {})
+    parties = list(dict.fromkeys(list(party_swings) + [party]))
+    swings = np.arange(101)
+
+    scenarios = np.tile([party_swings.get(p, 0) for p in parties], (len(swings), 1))
+    scenarios[:, parties.index(party)] = swings
+    winners = np.concatenate([w for _, w in engine.winners_batch(scenarios, parties)])
+
+    return swings, winners, count_seats(winners, len(engine.outcomes))
+
+
+# divisors for the highest-averages list PR methods, given a number of seats
+pr_divisors = {
+    'dhondt': lambda n: np.arange(1, n + 1),
+    'sainte_lague': lambda n: np.arange(n) * 2 + 1,
+}
+
+
+class RegionalPR:
+    """Regional list PR seat totals for any set of constituency votes.
+
+    Each region elects as many members as it has constituencies, shared out
+    by a highest-averages method. Every party's quotients in every region
+    are built in one array, and the largest ones in each region win seats;
+    ties for a region's last seat go to the earlier party column.
+    """
+
+    def __init__(self, engine, regions):
+        self.engine = engine
+        self.regions, region_codes = np.unique(np.asarray(regions), return_inverse=True)
+        # regions x constituencies membership, so region totals are one product
+        self.membership = np.zeros((len(self.regions), len(engine.votes)))
+        self.membership[region_codes, np.arange(len(engine.votes))] = 1
+        self.region_seats = np.bincount(region_codes, minlength=len(self.regions))
+
+    def region_votes(self, result):
+        return self.membership @ result.votes
+
+    def allocate(self, result, method='dhondt'):
+        """Seats per outcome (as engine.outcomes) in each region.
+
+        Returns a (regions x outcomes) array for a SwingResult's votes.
+        """
+        max_seats = self.region_seats.max()
+        votes = self.region_votes(result)
+        quotients = votes[:, :, None] / pr_divisors[method](max_seats)
+        quotients = quotients.reshape(len(votes), -1)
+
+        # only each region's own number of largest quotients win
+        order = np.argsort(-quotients, axis=1, kind='stable')[:, :max_seats]
+        elected = np.arange(max_seats) < self.region_seats[:, None]
+        parties = np.where(elected, order // max_seats, votes.shape[1])
+
+        return count_seats(parties, votes.shape[1] + 1)[:, :-1]
+
+    def seats(self, result, method='dhondt'):
+        return self.allocate(result, method).sum(axis=0)
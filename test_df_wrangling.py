@@ -0,0 +1,384 @@
+import gzip
+import json
+import os
+import shutil
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import df_wrangling
+
+from df_wrangling import (
+    _sheet_chunks,
+    boundaries_path,
+    build_bundle,
+    clean_df,
+    load_bundle,
+    load_results,
+    MappedArchive,
+    read_results,
+    results_dtypes,
+    results_path,
+    StaleBundleError,
+    SwingEngine,
+)
+
+slider_parties = ["C", "Lab", "SNP", "LD", "Green", "PC"]
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return SwingEngine(load_results())
+
+
+@pytest.fixture(scope="module")
+def raw_dfs():
+    return {
+        "read_excel": pd.read_excel(results_path),
+        "read_results": read_results(results_path),
+    }
+
+
+def pivot_clean_df(ge_df, year=2017):
+    # the pivot_table and merge version of clean_df, kept to check against
+    # (and, in benchmarks.py, to time)
+
+    ge_df = ge_df.loc[ge_df['Year']==year]
+
+    winning_parties = ge_df['Majority Party'].unique()
+    ge_df = ge_df.loc[ge_df['Party Abbreviation'].isin(winning_parties)]
+
+    general_constituency_info = ge_df.drop_duplicates('Constituency', keep='first')
+    general_constituency_info = general_constituency_info.drop(
+        ['Party Abbreviation','Party','Candidate Votes','Share of Vote'],
+        axis=1,
+        errors='ignore',
+    )
+
+    df_votes = ge_df[['Code','Party Abbreviation','Candidate Votes']]
+    df_votes = df_votes.pivot_table(
+        index='Code',
+        columns='Party Abbreviation',
+        values='Candidate Votes',
+        aggfunc=max,
+        observed=True,
+    # float, as read_excel's votes give; nullable Int32 votes would stay Int32
+    ).fillna(0).astype(float).reset_index()
+
+    return pd.merge(general_constituency_info, df_votes, how='outer', on='Code')
+
+
+@pytest.mark.parametrize("reader", ["read_excel", "read_results"])
+@pytest.mark.parametrize("year", [2010, 2015, 2017])
+def test_clean_df_matches_pivot_table(raw_dfs, reader, year):
+    raw_df = raw_dfs[reader]
+    pd.testing.assert_frame_equal(clean_df(raw_df, year), pivot_clean_df(raw_df, year))
+
+
+def test_clean_df_refuses_a_code_with_two_constituencies(raw_dfs):
+    raw_df = raw_dfs["read_excel"].copy()
+    first = raw_df.index[raw_df["Year"] == 2017][0]
+    code = raw_df.loc[first, "Code"]
+    raw_df.loc[first, "Constituency"] = "Somewhere else"
+
+    with pytest.raises(ValueError, match=code):
+        clean_df(raw_df)
+
+
+def test_partition_cache_is_versioned_and_restamped(tmp_path, monkeypatch):
+    path = str(tmp_path / "results.xls")
+    shutil.copy(results_path, path)
+    built = load_results(path, 2017)
+
+    # a cache from another version is rebuilt, not reused
+    monkeypatch.setattr(df_wrangling, "results_cache_version", -1)
+    assert df_wrangling._load_partition(path, 2017) is None
+    monkeypatch.undo()
+    pd.testing.assert_frame_equal(df_wrangling._load_partition(path, 2017), built)
+
+    # an unchanged workbook with a new mtime is hashed once, then restamped
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    hashed = []
+    monkeypatch.setattr(df_wrangling, "file_sha1", lambda p: hashed.append(p) or "")
+    assert df_wrangling._load_partition(path, 2017) is None
+    monkeypatch.undo()
+    pd.testing.assert_frame_equal(df_wrangling._load_partition(path, 2017), built)
+    monkeypatch.setattr(df_wrangling, "file_sha1", lambda p: hashed.append(p) or "")
+    pd.testing.assert_frame_equal(df_wrangling._load_partition(path, 2017), built)
+    assert len(hashed) == 1
+
+
+class ListSheet:
+    # the part of an xlrd sheet _sheet_chunks reads, over a list of rows
+    def __init__(self, rows):
+        self.rows = rows
+        self.nrows = len(rows)
+
+    def col_values(self, column, start, end):
+        return [row[column] for row in self.rows[start:end]]
+
+
+def test_blank_votes_read_as_missing():
+    header = list(results_dtypes)
+    row = {
+        'Year': 2017.0, 'Code': 'E1', 'Constituency': 'A', 'Region': 'R',
+        'Party Abbreviation': 'C', 'Candidate Votes': 100.0,
+        'Total constituency votes': 150.0, 'Majority Party': 'C',
+        'Majority': 50.0, 'Majority %': 33.3,
+    }
+    rows = [
+        row,
+        dict(row, **{'Party Abbreviation': 'Lab', 'Candidate Votes': ''}),
+        dict(row, **{'Party Abbreviation': 'Lab', 'Candidate Votes': 50.0, 'Code': 'E2', 'Constituency': 'B'}),
+        dict(row, **{'Party Abbreviation': 'Lab', 'Candidate Votes': '', 'Code': 'E2', 'Constituency': 'B'}),
+        dict(row, **{'Majority Party': 'Lab', 'Code': 'E2', 'Constituency': 'B'}),
+    ]
+    sheet = ListSheet([header] + [[r[c] for c in header] for r in rows])
+
+    raw_df = pd.concat(list(_sheet_chunks(sheet, header, None, chunk_rows=2)), ignore_index=True)
+    assert str(raw_df['Candidate Votes'].dtype) == 'Int32'
+    assert raw_df['Candidate Votes'].isna().tolist() == [False, True, False, True, False]
+
+    # a blank is no vote: a party with only blanks in a seat gets 0
+    ge_df = clean_df(raw_df)
+    assert ge_df['Lab'].tolist() == [0.0, 50.0]
+    assert ge_df['C'].tolist() == [100.0, 100.0]
+
+
+def random_swings(n, seed=0):
+    # whole-number swings, with plenty of 0s, 50s and 100s to hit exact ties
+    rng = np.random.default_rng(seed)
+    swings = rng.integers(0, 101, (n, len(slider_parties)))
+    swings[rng.random(swings.shape) < 0.3] = 0
+    swings[rng.random(swings.shape) < 0.1] = 50
+    swings[rng.random(swings.shape) < 0.05] = 100
+    return swings
+
+
+def assert_same_result(result, expected):
+    np.testing.assert_array_equal(result.swing, expected.swing)
+    np.testing.assert_array_equal(result.votes, expected.votes)
+    np.testing.assert_array_equal(result.winners, expected.winners)
+    np.testing.assert_array_equal(result.seats, expected.seats)
+
+
+def test_update_matches_apply(engine):
+    rng = np.random.default_rng(1)
+    party_swings = dict.fromkeys(slider_parties, 0)
+    result = engine.apply(party_swings)
+    for _ in range(500):
+        # mostly one slider at a time, as when dragging, sometimes several
+        n_moved = 1 if rng.random() < 0.8 else rng.integers(2, len(slider_parties) + 1)
+        for party in rng.choice(slider_parties, n_moved, replace=False):
+            party_swings[party] = int(rng.choice([0, 50, 100, rng.integers(0, 101)]))
+        result = engine.update(result, party_swings)
+        assert_same_result(result, engine.apply(party_swings))
+
+
+def test_seats_batch_matches_apply(engine):
+    swings = random_swings(300)
+    # a small chunk size so scenarios span several chunks
+    seats = engine.seats_batch(swings, slider_parties, chunk_size=7)
+    for row, expected_seats in zip(swings, seats):
+        result = engine.apply(dict(zip(slider_parties, row.tolist())))
+        np.testing.assert_array_equal(expected_seats, result.seats)
+
+
+def test_winners_batch_matches_apply(engine):
+    swings = random_swings(50, seed=2)
+    for start, winners in engine.winners_batch(swings, slider_parties, chunk_size=16):
+        for row, scenario_winners in zip(swings[start:], winners):
+            result = engine.apply(dict(zip(slider_parties, row.tolist())))
+            np.testing.assert_array_equal(scenario_winners, result.winners)
+
+
+def test_apply_transfers_matches_apply(engine):
+    for row in random_swings(40, seed=3):
+        party_swings = dict(zip(slider_parties, row.tolist()))
+        result = engine.apply_transfers({p: {"New": s} for p, s in party_swings.items()})
+        expected = engine.apply(party_swings)
+
+        np.testing.assert_allclose(result.votes, expected.votes, rtol=1e-12, atol=1e-9)
+        # winners can only differ where an exact tie rounds differently
+        ranked = np.sort(expected.votes, axis=1)
+        clear = ranked[:, -1] - ranked[:, -2] > 1e-6
+        np.testing.assert_array_equal(result.winners[clear], expected.winners[clear])
+
+
+def test_transfer_matrix_keeps_what_isnt_passed_on(engine):
+    transfers = engine.transfer_matrix({"C": {"Lab": 10, "New": 15, "C": 50}, "LD": {"Lab": 100}})
+    c, lab, ld, new = (engine.outcome_index[p] for p in ["C", "Lab", "LD", "New"])
+
+    np.testing.assert_allclose(transfers.sum(axis=1), 1)
+    # a party's own column is what it keeps, whatever it is given
+    assert transfers[c, c] == pytest.approx(0.75)
+    assert transfers[c, lab] == pytest.approx(0.10)
+    assert transfers[c, new] == pytest.approx(0.15)
+    assert transfers[ld, ld] == 0
+    assert transfers[lab, lab] == 1
+
+
+@pytest.mark.parametrize("flows, message", [
+    ({"C": {"Lab": -5}}, "between 0 and 100"),
+    ({"C": {"Lab": 120}}, "between 0 and 100"),
+    ({"C": {"Lab": 60, "New": 50}}, "more than 100%"),
+])
+def test_transfer_matrix_refuses_impossible_flows(engine, flows, message):
+    with pytest.raises(ValueError, match=message):
+        engine.transfer_matrix(flows)
+
+
+def tactical_reference(engine, tactical, party_swings):
+    # one constituency at a time: everyone but the top two passes on their
+    # tactical share to whoever is second
+    votes = engine.apply(party_swings).votes.copy()
+    for row in votes:
+        ranked = sorted(range(len(row)), key=lambda i: (-row[i], i))
+        incumbent, challenger = ranked[0], ranked[1]
+        moved = 0.0
+        for party, percentage in tactical.items():
+            i = engine.outcome_index[party]
+            if i in (incumbent, challenger):
+                continue
+            moving = row[i] * (percentage / 100)
+            row[i] -= moving
+            moved += moving
+        row[challenger] += moved
+    return votes
+
+
+@pytest.mark.parametrize("tactical, party_swings", [
+    ({"LD": 30}, {}),
+    ({"LD": 50, "Green": 100}, {"C": 20}),
+    ({"Lab": 25, "LD": 40, "Green": 60, "PC": 10}, {"C": 10, "Lab": 15}),
+    ({"New": 50, "LD": 100}, {"C": 50, "Lab": 50}),
+])
+def test_apply_tactical_matches_row_loop(engine, tactical, party_swings):
+    result = engine.apply_tactical(tactical, engine.apply(party_swings))
+    expected = tactical_reference(engine, tactical, party_swings)
+
+    np.testing.assert_allclose(result.votes, expected, rtol=1e-12)
+    np.testing.assert_array_equal(result.winners, expected.argmax(axis=1))
+
+
+@pytest.fixture(scope="module")
+def bundle_sources(tmp_path_factory):
+    # copies, so the tests can change them without touching data/
+    directory = tmp_path_factory.mktemp("sources")
+    results = str(directory / "results.xls")
+    boundaries = str(directory / "boundaries.json")
+    shutil.copy(results_path, results)
+    shutil.copy(boundaries_path, boundaries)
+    return results, boundaries
+
+
+@pytest.fixture(scope="module")
+def bundle(bundle_sources, tmp_path_factory):
+    results, boundaries = bundle_sources
+    return build_bundle(str(tmp_path_factory.mktemp("bundle") / "bundle.npz"), [results], boundaries)
+
+
+def test_bundle_matches_its_sources(bundle, bundle_sources):
+    results, _ = bundle_sources
+    loaded = load_bundle(bundle)
+
+    assert loaded.years == [2010, 2015, 2017]
+    for year in loaded.years:
+        pd.testing.assert_frame_equal(loaded.results(year), load_results(results, year))
+        np.testing.assert_array_equal(
+            loaded.engine(year).votes, SwingEngine(load_results(results, year)).votes
+        )
+    for level in range(len(loaded.detail_level_zooms)):
+        geometry = bytes(loaded.geometry(level))
+        assert gzip.decompress(bytes(loaded.compressed_geometry(level))) == geometry
+        ids = [f["properties"]["id"] for f in json.loads(geometry)["features"]]
+        assert ids == loaded.feature_ids.tolist()
+
+
+def test_bundle_survives_a_touched_source(bundle, bundle_sources):
+    # a new mtime alone is checked against the hash, and passes
+    _, boundaries = bundle_sources
+    os.utime(boundaries, ns=(0, os.stat(boundaries).st_mtime_ns + 10 ** 9))
+    load_bundle(bundle)
+
+
+def test_bundle_refuses_a_changed_source(bundle, bundle_sources, tmp_path):
+    _, boundaries = bundle_sources
+    changed = str(tmp_path / "boundaries.json")
+    shutil.copy(boundaries, changed)
+    stale = build_bundle(str(tmp_path / "stale.npz"), [bundle_sources[0]], changed)
+    with open(changed, "a") as f:
+        f.write(" ")
+
+    with pytest.raises(StaleBundleError, match="has changed"):
+        load_bundle(stale)
+    os.remove(changed)
+    with pytest.raises(StaleBundleError, match="is missing"):
+        load_bundle(stale)
+
+
+@pytest.mark.parametrize("version", ["bundle_version", "results_cache_version"])
+def test_bundle_refuses_another_version(bundle, monkeypatch, version):
+    monkeypatch.setattr(df_wrangling, version, getattr(df_wrangling, version) + 1)
+    with pytest.raises(StaleBundleError, match="another version"):
+        load_bundle(bundle)
+
+
+def test_missing_bundle_is_stale(tmp_path):
+    with pytest.raises(StaleBundleError, match="does not exist"):
+        load_bundle(str(tmp_path / "none.npz"))
+
+
+mapped_arrays = {
+    "matrix": np.arange(12.0).reshape(3, 4),
+    "fortran": np.asfortranarray(np.arange(12, dtype=np.int32).reshape(3, 4)),
+    "strings": np.array(["C", "Lab", "Green"]),
+    "bytes": np.frombuffer(b"geojson", dtype=np.uint8),
+    "scalar": np.int64(6),
+    "text": np.array("0123abcd"),
+    "empty": np.zeros((0, 3)),
+    "empty_strings": np.array([], dtype=str),
+}
+
+
+def test_mapped_archive_matches_np_load(tmp_path):
+    path = str(tmp_path / "arrays.npz")
+    np.savez(path, **mapped_arrays)
+    archive = MappedArchive(path)
+
+    with np.load(path) as expected:
+        for key in mapped_arrays:
+            assert key in archive
+            assert archive[key].dtype == expected[key].dtype
+            np.testing.assert_array_equal(archive[key], expected[key])
+    assert archive["fortran"].flags.f_contiguous
+    assert isinstance(archive["matrix"], np.memmap)
+    assert not archive["matrix"].flags.writeable
+
+
+def write_npy_version(path, array, version):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+        with archive.open("array.npy", "w") as f:
+            np.lib.format.write_array(f, array, version=version)
+
+
+def test_mapped_archive_reads_npy_version_2(tmp_path):
+    path = str(tmp_path / "v2.npz")
+    write_npy_version(path, np.arange(5.0), (2, 0))
+    np.testing.assert_array_equal(MappedArchive(path)["array"], np.arange(5.0))
+
+
+def test_mapped_archive_refuses_unknown_npy_versions(tmp_path):
+    path = str(tmp_path / "v3.npz")
+    write_npy_version(path, np.arange(5.0), (3, 0))
+    with pytest.raises(ValueError, match="version 3.0"):
+        MappedArchive(path)["array"]
+
+
+def test_mapped_archive_refuses_a_compressed_archive(tmp_path):
+    path = str(tmp_path / "compressed.npz")
+    np.savez_compressed(path, **mapped_arrays)
+    with pytest.raises(ValueError, match="compressed"):
+        MappedArchive(path)
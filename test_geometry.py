@@ -0,0 +1,24 @@
+import os
+import shutil
+
+from geometry import boundaries_path, load_topology, read_topojson, topology_path_for
+
+
+def test_topology_is_built_next_to_its_source(tmp_path):
+    source = str(tmp_path / "boundaries.json")
+    shutil.copy(boundaries_path, source)
+
+    topology = load_topology(source=source)
+    path = topology_path_for(source)
+    assert os.path.exists(path)
+    assert [f for f in os.listdir(tmp_path) if f.endswith(".tmp")] == []
+    # readable by whoever could read a file written in place
+    plain = tmp_path / "plain.json"
+    plain.write_text("{}")
+    assert os.stat(path).st_mode & 0o777 == os.stat(plain).st_mode & 0o777
+    assert len(topology["objects"]) == len(read_topojson(path)["objects"])
+
+    # a newer source is rebuilt from, not served from the old file
+    os.utime(path, ns=(0, os.stat(source).st_mtime_ns - 10 ** 9))
+    load_topology(source=source)
+    assert os.stat(path).st_mtime_ns >= os.stat(source).st_mtime_ns
@@ -0,0 +1,165 @@
+import heapq
+import sys
+
+import numpy as np
+import pytest
+
+from df_wrangling import load_results, party_renaming_dict, SwingEngine
+from scenarios import (
+    FlipIndex,
+    lose_majority_target,
+    majority_target,
+    minimal_swing,
+    monte_carlo,
+    pr_divisors,
+    RegionalPR,
+    SeatTarget,
+    target_met,
+)
+
+slider_parties = ["C", "Lab", "SNP", "LD", "Green", "PC"]
+
+
+@pytest.fixture(scope="module")
+def ge_df():
+    return load_results()
+
+
+@pytest.fixture(scope="module")
+def engine(ge_df):
+    return SwingEngine(ge_df)
+
+
+@pytest.fixture(scope="module")
+def flip_index(engine):
+    return FlipIndex(engine, slider_parties)
+
+
+def flip_swings(flip_index, party):
+    # every tenth of a percent, and a swing between each pair of neighbouring
+    # thresholds so every interval the index distinguishes is visited; right
+    # at a threshold the percentage doesn't round-trip exactly, so it isn't
+    swings, _, _ = flip_index._events[party]
+    thresholds = np.unique(np.concatenate([[0, 1], swings])) * 100
+    return np.unique(np.concatenate([
+        np.round(np.arange(0, 100.05, 0.1), 1),
+        (thresholds[:-1] + thresholds[1:]) / 2,
+    ]))
+
+
+@pytest.mark.parametrize("party", slider_parties)
+def test_flip_index_seats_match_apply(engine, flip_index, party):
+    for swing in flip_swings(flip_index, party):
+        np.testing.assert_array_equal(
+            flip_index.seats(party, swing), engine.apply({party: swing}).seats
+        )
+
+
+@pytest.mark.parametrize("party", slider_parties)
+def test_flip_index_flips_match_apply(engine, flip_index, party):
+    base_winners = engine.apply({}).winners
+    for swing in flip_swings(flip_index, party)[::7]:
+        winners = engine.apply({party: swing}).winners
+        changed = np.flatnonzero(winners != base_winners)
+
+        flips_df = flip_index.flips(party, swing)
+        expected = {
+            code: party_renaming_dict.get(to, to)
+            for code, to in zip(engine.codes[changed], engine.outcomes[winners[changed]])
+        }
+        assert dict(zip(flips_df['Code'], flips_df['to'])) == expected
+
+
+def test_a_party_that_stood_nowhere_changes_nothing(engine):
+    # "Brexit" has no column in the vote matrix
+    flip_index = FlipIndex(engine, ["C", "Brexit"])
+    base = engine.apply({})
+
+    np.testing.assert_array_equal(engine.apply({"Brexit": 40}).seats, base.seats)
+    np.testing.assert_array_equal(
+        engine.seats_batch([[10, 40]], ["C", "Brexit"])[0], engine.apply({"C": 10}).seats
+    )
+    np.testing.assert_array_equal(flip_index.seats("Brexit", 40), base.seats)
+    assert flip_index.flips("Brexit", 40).empty
+    assert flip_index.marginal_seats("Brexit").empty
+
+
+@pytest.mark.parametrize("make_target", [
+    majority_target,
+    lose_majority_target,
+    lambda engine: SeatTarget("Lab", 250, False),
+])
+def test_minimal_swing_never_rises_with_more_parties(engine, make_target):
+    target = make_target(engine)
+    totals = []
+    for parties in [["Lab"], ["C", "Lab"], ["C", "Lab", "LD"], slider_parties]:
+        party_swings = minimal_swing(engine, target, parties)
+        if party_swings is None:
+            totals.append(np.inf)
+            continue
+        assert target_met(engine, target, engine.apply(party_swings).seats)
+        totals.append(sum(party_swings.values()))
+
+    assert np.isfinite(totals[-1])
+    assert totals == sorted(totals, reverse=True)
+
+
+def test_monte_carlo_needs_a_simulation(engine):
+    with pytest.raises(ValueError):
+        monte_carlo(engine, {"C": 10}, n_simulations=0, workers=1)
+
+
+def test_monte_carlo_chunks_add_up(engine):
+    result = monte_carlo(engine, {"C": ("normal", 10, 5)}, 2500, seed=0, workers=1, chunk_size=1000)
+
+    assert result.seats.shape == (2500, len(engine.outcomes))
+    np.testing.assert_array_equal(result.seats.sum(axis=1), len(engine.votes))
+    np.testing.assert_allclose(result.win_probability.sum(axis=1), 1)
+
+
+def test_monte_carlo_pool_matches_one_process(engine):
+    main = sys.modules["__main__"]
+    args = (engine, {"C": ("normal", 10, 5), "Lab": ("uniform", 0, 20)}, 3000)
+    pooled = monte_carlo(*args, seed=1, workers=2, chunk_size=1000)
+    local = monte_carlo(*args, seed=1, workers=1, chunk_size=1000)
+
+    np.testing.assert_array_equal(pooled.seats, local.seats)
+    np.testing.assert_array_equal(pooled.win_probability, local.win_probability)
+    # the script's module is only stood in for while workers start
+    assert sys.modules["__main__"] is main
+
+
+def regional_pr_reference(regions, region_seats, region_votes, method):
+    # one seat at a time from a heap of each party's next quotient; ties go
+    # to the earlier party column
+    seats = np.zeros(region_votes.shape, dtype=int)
+    for r in range(len(regions)):
+        divisors = pr_divisors[method](region_seats[r])
+        heap = [(-v / divisors[0], p) for p, v in enumerate(region_votes[r])]
+        heapq.heapify(heap)
+        for _ in range(region_seats[r]):
+            _, p = heapq.heappop(heap)
+            seats[r, p] += 1
+            if seats[r, p] < len(divisors):
+                heapq.heappush(heap, (-region_votes[r, p] / divisors[seats[r, p]], p))
+    return seats
+
+
+@pytest.mark.parametrize("method", list(pr_divisors))
+@pytest.mark.parametrize("party_swings", [
+    {},
+    {"C": 20, "Lab": 10},
+    {"C": 50, "Lab": 50, "SNP": 100},
+])
+def test_regional_pr_matches_heap(ge_df, engine, method, party_swings):
+    regional_pr = RegionalPR(engine, ge_df["Region"])
+    result = engine.apply(party_swings)
+
+    expected = regional_pr_reference(
+        regional_pr.regions,
+        regional_pr.region_seats,
+        regional_pr.region_votes(result),
+        method,
+    )
+    np.testing.assert_array_equal(regional_pr.allocate(result, method), expected)
+    np.testing.assert_array_equal(regional_pr.seats(result, method), expected.sum(axis=0))